@@ -0,0 +1,240 @@
+import logging
+import time
+import traceback
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin
+
+from hikvision_client import HikvisionClient
+from metrics import ENDPOINT_ALERT_STREAM
+from model import EventNotificationAlert
+
+
+class MultipartStreamParser:
+    """Incremental multipart/mixed parser.
+    feed() takes bytes as they arrive and returns completed parts,
+    every byte of the buffer is scanned once.
+    feed_stream() returns part events instead, so large bodies are never held whole.
+    """
+
+    STATE_BOUNDARY = 0
+    STATE_HEADERS = 1
+    STATE_BODY = 2
+
+    EVENT_HEADERS = "headers"
+    EVENT_DATA = "data"
+    EVENT_END = "end"
+
+    COMPACT_SIZE = 64 * 1024
+
+    def __init__(self, boundary: Optional[str] = None):
+        self.boundary = boundary.encode() if boundary else None
+        self._buffer = bytearray()
+        self._pos = 0
+        self._scan = 0
+        self._state = self.STATE_BOUNDARY
+        self._headers = {}
+        self._length = None
+
+    def feed(self, data: bytes) -> List[Tuple[dict, bytes]]:
+        self._buffer += data
+        parts = []
+        while True:
+            if self._state == self.STATE_BOUNDARY:
+                if not self.__read_boundary__():
+                    break
+            elif self._state == self.STATE_HEADERS:
+                if not self.__read_headers__():
+                    break
+            else:
+                body = self.__read_body__()
+                if body is None:
+                    break
+                parts.append((self._headers, body))
+        self.__compact__()
+        return parts
+
+    def feed_stream(self, data: bytes) -> List[Tuple[str, Any]]:
+        """Events for the data: (EVENT_HEADERS, headers), (EVENT_DATA, bytes) as the body arrives,
+         (EVENT_END, None) when the part is complete
+        """
+        self._buffer += data
+        events = []
+        while True:
+            if self._state == self.STATE_BOUNDARY:
+                if not self.__read_boundary__():
+                    break
+            elif self._state == self.STATE_HEADERS:
+                if not self.__read_headers__():
+                    break
+                events.append((self.EVENT_HEADERS, self._headers))
+            else:
+                chunk, done = self.__read_body_chunk__()
+                if chunk:
+                    events.append((self.EVENT_DATA, chunk))
+                if not done:
+                    break
+                events.append((self.EVENT_END, None))
+        self.__compact__()
+        return events
+
+    def __find__(self, needle: bytes) -> int:
+        index = self._buffer.find(needle, max(self._scan, self._pos))
+        if index < 0:
+            self._scan = max(self._pos, len(self._buffer) - len(needle) + 1)
+        return index
+
+    def __read_line__(self) -> Optional[bytes]:
+        end = self.__find__(b"\n")
+        if end < 0:
+            return None
+        line = bytes(self._buffer[self._pos:end]).rstrip(b"\r")
+        self._pos = self._scan = end + 1
+        return line
+
+    def __read_boundary__(self) -> bool:
+        while True:
+            line = self.__read_line__()
+            if line is None:
+                return False
+            if not line.startswith(b"--"):
+                continue
+            if self.boundary is None:
+                self.boundary = line[2:]
+            elif not line.startswith(b"--" + self.boundary):
+                continue
+            self._state = self.STATE_HEADERS
+            self._headers = {}
+            return True
+
+    def __read_headers__(self) -> bool:
+        while True:
+            line = self.__read_line__()
+            if line is None:
+                return False
+            if line == b"":
+                if not self._headers:
+                    # Пустые строки перед заголовками у некоторых прошивок
+                    continue
+                length = self._headers.get("content-length")
+                self._length = int(length) if length and length.isdigit() else None
+                self._state = self.STATE_BODY
+                return True
+            name, _, value = line.decode("latin-1").partition(":")
+            self._headers[name.strip().lower()] = value.strip()
+
+    def __read_body__(self) -> Optional[bytes]:
+        if self._length is not None:
+            end = self._pos + self._length
+            if len(self._buffer) < end:
+                return None
+            body = bytes(self._buffer[self._pos:end])
+            self._pos = self._scan = end
+        else:
+            end = self.__find__(b"\r\n--" + self.boundary)
+            if end < 0:
+                return None
+            body = bytes(self._buffer[self._pos:end])
+            self._pos = self._scan = end + 2
+        self._state = self.STATE_BOUNDARY
+        return body
+
+    def __read_body_chunk__(self) -> Tuple[bytes, bool]:
+        if self._length is not None:
+            end = min(len(self._buffer), self._pos + self._length)
+            chunk = bytes(self._buffer[self._pos:end])
+            self._length -= end - self._pos
+            self._pos = self._scan = end
+            if self._length:
+                return chunk, False
+        else:
+            delimiter = b"\r\n--" + self.boundary
+            end = self.__find__(delimiter)
+            if end < 0:
+                # Хвост может оказаться началом разделителя - его оставляем в буфере
+                end = max(self._pos, len(self._buffer) - len(delimiter) + 1)
+                chunk = bytes(self._buffer[self._pos:end])
+                self._pos = end
+                return chunk, False
+            chunk = bytes(self._buffer[self._pos:end])
+            self._pos = self._scan = end + 2
+        self._state = self.STATE_BOUNDARY
+        return chunk, True
+
+    def __compact__(self):
+        if self._pos >= self.COMPACT_SIZE or self._pos == len(self._buffer):
+            del self._buffer[:self._pos]
+            self._scan = max(0, self._scan - self._pos)
+            self._pos = 0
+
+
+class AlertStream:
+    """Consumer of /ISAPI/Event/notification/alertStream.
+    Yields (EventNotificationAlert, None) for every xml part and (alert, image bytes)
+    for every image part attached to the last alert. Reconnects with backoff.
+    """
+
+    CHUNK_SIZE = 16 * 1024
+    BACKOFF_MIN = 1.0
+    BACKOFF_MAX = 60.0
+
+    def __init__(self, client: HikvisionClient, read_timeout=90):
+        self.client = client
+        self.read_timeout = float(read_timeout)
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def events(self) -> Iterator[Tuple[EventNotificationAlert, Optional[bytes]]]:
+        backoff = self.BACKOFF_MIN
+        while self.running:
+            received = False
+            try:
+                for event in self.__read_stream__():
+                    received = True
+                    backoff = self.BACKOFF_MIN
+                    yield event
+                if received:
+                    logging.info("Alert stream closed by camera, reconnect")
+                    continue
+                # Камера ответила и сразу закрыла поток - без паузы это цикл запросов
+                logging.info(f"Alert stream closed by camera without events, reconnect in {backoff}s")
+            except Exception:
+                logging.error(f"Alert stream error, reconnect in {backoff}s")
+                logging.debug(traceback.format_exc())
+            if not self.running:
+                return
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.BACKOFF_MAX)
+
+    def listen(self, callback: Callable[[EventNotificationAlert, Optional[bytes]], None]):
+        for alert, image in self.events():
+            callback(alert, image)
+
+    def __read_stream__(self) -> Iterator[Tuple[EventNotificationAlert, Optional[bytes]]]:
+        full_url = urljoin(self.client.host, self.client.isapi_prefix + '/Event/notification/alertStream')
+        # Через __request__: согласование Basic/Digest и breaker как у остальных запросов, без повторов
+        with self.client.__request__(ENDPOINT_ALERT_STREAM, "GET", full_url, stream=True,
+                                     timeout=(self.client.timeout, self.read_timeout)) as response:
+            response.raise_for_status()
+            parser = MultipartStreamParser(_boundary(response.headers.get("Content-Type", "")))
+            alert = None
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                if not self.running:
+                    return
+                for headers, body in parser.feed(chunk):
+                    content_type = headers.get("content-type", "")
+                    if "xml" in content_type or body.lstrip().startswith(b"<"):
+                        alert = EventNotificationAlert.from_xml_str(body)
+                        logging.debug(f"Alert: {alert.type}, state: {alert.state}, channel: {alert.channel_id}")
+                        yield alert, None
+                    elif alert is not None:
+                        yield alert, body
+
+
+def _boundary(content_type: str) -> Optional[str]:
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "boundary":
+            return value.strip('"')
+    return None
@@ -2,6 +2,7 @@ import logging
 import os
 import time
 
+from capture_scheduler import CaptureScheduler
 from hikvision_client import HikvisionClient
 from loggerinitializer import initialize_logger
 
@@ -9,21 +10,29 @@ from loggerinitializer import initialize_logger
 def main():
     logging.basicConfig(level=logging.DEBUG)
     cam = HikvisionClient('http://192.168.0.221', 'user', '1q2w3e4r')
+    # Схема авторизации на диске: HikvisionClient(..., auth_cache=AuthSchemeCache("auth.json")),
+    # для парка камер FleetPoller(auth_cache_path="auth.json")
     device_info = cam.get_status()
     logging.info(
         f"serial_number: {device_info.serial_number}, name: {device_info.device_name}, "
         f"firmware: {device_info.firmware_version}, firmware date {device_info.firmware_date_release}")
+    # cam.enable_image_storage(os.path.abspath("images"), max_age_days=30, max_bytes=50 * 1024 ** 3)
+    # После простоя: Backfill(cam, cam.last_time, concurrency=4, checkpoint_path="backfill.json").run()
+    # при HikvisionClient(..., watermark_path="watermark"), затем обычный опрос
     # cam.background_download_pictures(os.path.abspath(os.curdir), only_with_number=False)
     # while True:
     #    cam.get_pictures()
     #    time.sleep(0.3)
 
-    # cam.listener_events_server()
+    # for alert, image in AlertStream(cam).events():
+    #    logging.info(f"Event: {alert.type}, state: {alert.state}")
+    # Камеры сами шлют события на http://<host>:8080/ - без опроса
+    # PushReceiver(os.path.abspath("push_pictures"), port=8080, callback=print).serve_forever()
+    # cam.frame_ring = FrameRing(name="hik_frames") - кадры читает другой процесс: FrameRingReader("hik_frames", 0)
     cam.manual_cup(os.path.abspath(os.curdir), unrecognized_photo_save=True)
-    logging.info("Starting loop manual cup")
-    while True:
-        # input("Press enter for manual_cup: \n")
-        response = cam.manual_cup(os.path.abspath(os.curdir))
+    # input("Press enter for manual_cup: \n") -> scheduler.trigger()
+    scheduler = CaptureScheduler(cam, os.path.abspath(os.curdir))
+    scheduler.run()
 
 
 if __name__ == '__main__':
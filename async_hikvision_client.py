@@ -0,0 +1,330 @@
+import asyncio
+import datetime
+import logging
+import os.path
+import random
+import time
+import uuid
+from typing import AsyncIterator
+from urllib.parse import urljoin
+
+import httpx
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from hikvision_client import HikvisionClient, DEFAULT_READ_TIMEOUTS, IDEMPOTENT_ENDPOINTS
+from metrics import ENDPOINT_DEVICE_INFO, ENDPOINT_SEARCH, ENDPOINT_PICTURE_INFORMATION, ENDPOINT_DOWNLOAD, \
+    ENDPOINT_MANUAL_CAP, STATUS_TIMEOUT, STATUS_ERROR, STATUS_CIRCUIT_OPEN
+from payload_log import PayloadLog
+from seen_index import SeenIndex
+from model import DeviceInfo, CMSearchResult, PictureInformation, Fixation, SearchMatchItem
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class AsyncHikvisionClient:
+    """asyncio variant of HikvisionClient built on httpx.AsyncClient.
+    One event loop can drive many cameras, each call only awaits network io.
+    """
+
+    def __init__(self, host, login=None, password=None, timeout=3, isapi_prefix='ISAPI', known_play_uri_path=None,
+                 max_connections=10, watermark_path=None):
+        self.host = host
+        self.login = login
+        self.password = password
+        self.timeout = float(timeout)
+        self.isapi_prefix = isapi_prefix
+        self.max_connections = max_connections
+        self.req = None
+        self.last_time = None
+        self.known_play_uri = SeenIndex(path=known_play_uri_path)
+        self.watermark_path = watermark_path
+        self.watermark_margin = 60
+        self.__load_watermark__()
+        self.search_page_size = 20
+        self.fixation_store = None
+        self.coalescer = None
+        self.image_writer = None
+        self.image_storage = None
+        self.watchlist = None
+        self.frame_ring = None
+        self.metrics_hooks = []
+        self.payload_log = PayloadLog(host)
+        # Тот же слой запросов, что у HikvisionClient: таймауты по endpoint, повторы и breaker
+        self.timeouts = {endpoint: httpx.Timeout(read, connect=self.timeout)
+                         for endpoint, read in DEFAULT_READ_TIMEOUTS.items()}
+        self.retries = 2
+        self.retry_backoff = 0.2
+        self.breaker = CircuitBreaker(name=host)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        if self.req is None:
+            self.req = await self._check_session()
+        return self
+
+    async def close(self):
+        if self.coalescer is not None:
+            # Открытые проезды отдаются в callback
+            await asyncio.to_thread(self.coalescer.close)
+            self.coalescer = None
+        if self.req is not None:
+            await self.req.aclose()
+            self.req = None
+
+    async def _check_session(self) -> httpx.AsyncClient:
+        """Check the connection with device
+         :return httpx.AsyncClient() object
+        """
+        full_url = urljoin(self.host, self.isapi_prefix + '/System/deviceInfo')
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        session = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        session.auth = httpx.BasicAuth(self.login, self.password)
+        response = await session.get(full_url)
+        if response.status_code != 401:
+            return session
+        session.auth = httpx.DigestAuth(self.login, self.password)
+        return session
+
+    async def __request__(self, endpoint, method, full_url, stream=False, **kwargs) -> httpx.Response:
+        """Same as HikvisionClient.__request__: circuit breaker, per endpoint timeout, retries for
+         idempotent endpoints and metrics hooks. With stream=True the body is not read,
+         the caller closes the response with aclose()
+        """
+        time_start = time.perf_counter()
+        try:
+            response = await self.__send__(endpoint, method, full_url, stream, **kwargs)
+        except CircuitOpenError:
+            self.__on_request__(endpoint, STATUS_CIRCUIT_OPEN, time_start)
+            raise
+        except httpx.TimeoutException:
+            self.__on_request__(endpoint, STATUS_TIMEOUT, time_start)
+            raise
+        except httpx.HTTPError:
+            self.__on_request__(endpoint, STATUS_ERROR, time_start)
+            raise
+        if self.metrics_hooks:
+            size = int(response.headers.get("Content-Length") or 0) if stream else len(response.content)
+            self.__on_request__(endpoint, response.status_code, time_start, size)
+        return response
+
+    async def __send__(self, endpoint, method, full_url, stream, **kwargs) -> httpx.Response:
+        self.breaker.check()
+        kwargs.setdefault("timeout", self.timeouts.get(endpoint, self.timeout))
+        attempts = self.retries + 1 if endpoint in IDEMPOTENT_ENDPOINTS else 1
+        for attempt in range(attempts):
+            try:
+                request = self.req.build_request(method, full_url, **kwargs)
+                response = await self.req.send(request, stream=stream)
+            except httpx.HTTPError as e:
+                self.breaker.failure()
+                if attempt + 1 >= attempts or not self.breaker.allow():
+                    raise
+                error = e
+            else:
+                if response.status_code < 500:
+                    self.breaker.success()
+                    break
+                self.breaker.failure()
+                if attempt + 1 >= attempts or not self.breaker.allow():
+                    break
+                await response.aclose()
+                error = response.status_code
+            delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+            logging.debug("Request %s failed: %s, retry %s in %.2fs", endpoint, error, attempt + 1, delay)
+            await asyncio.sleep(delay)
+        return response
+
+    async def get_status(self) -> DeviceInfo:
+        await self.open()
+        full_url = urljoin(self.host, self.isapi_prefix + '/System/deviceInfo')
+        response = await self.__request__(ENDPOINT_DEVICE_INFO, "GET", full_url)
+        return DeviceInfo.from_xml_str(response.text)
+
+    async def __get_pictures__(self, time_start, count=10, time_end=None, position=0, search_id=None) -> CMSearchResult:
+        await self.open()
+        date_time_start = time_start.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if time_end is None:
+            time_end = datetime.datetime.now()
+        date_time_end = time_end.strftime("%Y-%m-%dT%H:%M:%SZ")
+        request_id = search_id if search_id is not None else uuid.uuid4()
+        logging.debug("Trying get pictures: %s start: %s end: %s position: %s", request_id, date_time_start,
+                      date_time_end, position)
+        data = f"""
+                <?xml version="1.0" encoding="utf-8"?>
+                <CMSearchDescription><searchID>{request_id}</searchID>
+                <trackIDList><trackID>120</trackID></trackIDList>
+                <timeSpanList><timeSpan>
+                <startTime>{date_time_start}</startTime>
+                <endTime>{date_time_end}</endTime>
+                <laneNumber></laneNumber><carType>all</carType><illegalType>all</illegalType></timeSpan>
+                </timeSpanList><contentTypeList><contentType>metadata</contentType>
+                </contentTypeList><maxResults>{count}</maxResults><searchResultPostion>{position}</searchResultPostion>
+                <metadataList><metadataDescriptor>//recordType.meta.hikvision.com/timing</metadataDescriptor>
+                <SearchProperity><plateSearchMask></plateSearchMask></SearchProperity></metadataList></CMSearchDescription>
+                        """
+
+        full_url = urljoin(self.host, self.isapi_prefix + '/ContentMgmt/search')
+        response = await self.__request__(ENDPOINT_SEARCH, "POST", full_url, content=data)
+        self.payload_log.debug("%s result: %s with: %s", response.status_code, lambda: response.text)
+        response.raise_for_status()
+
+        return CMSearchResult.from_xml_str(response.text)
+
+    async def search(self, time_start, time_end=None, page_size=20) -> AsyncIterator[SearchMatchItem]:
+        """Same as HikvisionClient.search: all matches of the window, page by page with one searchID"""
+        if time_end is None:
+            time_end = datetime.datetime.now()
+        search_id = uuid.uuid4()
+        position = 0
+        while True:
+            cms_result = await self.__get_pictures__(time_start=time_start, count=page_size, time_end=time_end,
+                                                     position=position, search_id=search_id)
+            logging.debug("Id: %s, count: %s, status: %s", cms_result.search_id, cms_result.count,
+                          cms_result.status_string)
+            page = cms_result.search_list
+            for result in page:
+                yield result
+            position += len(page)
+            if not page or not cms_result.has_more():
+                return
+
+    async def get_pictures(self) -> list:
+        """Same as HikvisionClient.get_pictures: new fixations of the current window in event time order"""
+        time_start = self.get_date_time_start()
+        time_end = datetime.datetime.now()
+        new_results = []
+        async for result in self.search(time_start=time_start, time_end=time_end, page_size=self.search_page_size):
+            if result.play_back_uri not in self.known_play_uri:
+                logging.debug("Id: %s, time: %s, playback: %s", result.track_id, result.time_start,
+                              result.play_back_uri)
+                new_results.append(result)
+        new_results.sort(key=lambda r: r.time_start)
+
+        fixations = []
+        for result in new_results:
+            meta = await self.__get_meta_data__(result.play_back_uri)
+            logging.info("New fixation number: %s, time: %s, type: %s: color: %s", meta.number,
+                         result.time_start, meta.type, meta.color)
+            # Водяной знак по времени камеры, а не по локальным часам
+            result_time = result.time_start_datetime
+            # add() раз в save_interval пишет индекс на диск
+            await asyncio.to_thread(self.known_play_uri.add, result.play_back_uri, result_time.timestamp())
+            self.__move_watermark__(result_time)
+            fixation = Fixation(url=result.play_back_uri, number=meta.number, date_time=result.time_start,
+                                color=meta.color, car_type=meta.type)
+            if self.fixation_store is not None:
+                self.fixation_store.add_fixation(self.host, fixation)
+            self.__check_watchlist__(fixation.number)
+            fixations.append(fixation)
+        self.__move_watermark__(time_end - datetime.timedelta(seconds=self.watermark_margin))
+        await asyncio.to_thread(self.__save_watermark__)
+        return fixations
+
+    async def __get_meta_data__(self, play_back_uri) -> PictureInformation:
+        await self.open()
+        request_id = uuid.uuid4()
+        logging.debug("Trying get pictures: %s", request_id)
+        data = f"""
+                <?xml version="1.0"?><downloadRequest version="1.0" xmlns="http://urn:selfextension:psiaext-ver10-xsd"><playbackURI>
+                {play_back_uri}
+                </playbackURI></downloadRequest>   """
+        data = data.replace("&", "&amp;")
+        full_url = urljoin(self.host, self.isapi_prefix + '/ITC/ContentMgmt/pictureInformation')
+        response = await self.__request__(ENDPOINT_PICTURE_INFORMATION, "POST", full_url, content=data)
+        self.payload_log.debug("%s result: %s with: %s", response.status_code, lambda: response.text)
+        response.raise_for_status()
+
+        return PictureInformation.from_xml_str(response.text)
+
+    async def image_download(self, download_path, url, name, date_time=None):
+        await self.open()
+        logging.debug("Download pictures: %s", url)
+        data = f"""
+                       <?xml version="1.0"?><downloadRequest version="1.0" xmlns="http://urn:selfextension:psiaext-ver10-xsd"><playbackURI>
+                       {url}
+                       </playbackURI></downloadRequest>   """
+        data = data.replace("&", "&amp;")
+        full_url = urljoin(self.host, self.isapi_prefix + '/ITC/ContentMgmt/download')
+        # Диск - в потоке, медленная запись не держит остальные камеры цикла
+        file_name = await asyncio.to_thread(self.__image_path__, download_path, name, date_time)
+        response = await self.__request__(ENDPOINT_DOWNLOAD, "GET", full_url, stream=True, content=data)
+        try:
+            if response.status_code == 200:
+                written = 0
+                write_time = 0.0
+                # Как в синхронном клиенте: временный файл и переименование, без обрезанных jpg
+                tmp_name = file_name + ".part"
+                f = await asyncio.to_thread(open, tmp_name, 'wb')
+                try:
+                    try:
+                        async for chunk in response.aiter_bytes():
+                            write_start = time.perf_counter()
+                            await asyncio.to_thread(f.write, chunk)
+                            write_time += time.perf_counter() - write_start
+                            written += len(chunk)
+                    finally:
+                        await asyncio.to_thread(f.close)
+                    await asyncio.to_thread(os.replace, tmp_name, file_name)
+                except BaseException:
+                    await asyncio.to_thread(_remove, tmp_name)
+                    raise
+                await asyncio.to_thread(self.__on_image_written__, file_name, write_time, written, date_time)
+        finally:
+            await response.aclose()
+
+        logging.debug("Download finish: %s", file_name)
+
+    async def manual_cup(self, path, unrecognized_photo_save=False):
+        await self.open()
+        logging.debug("Trying manual cup")
+        time_start = datetime.datetime.utcnow()
+        full_url = urljoin(self.host, self.isapi_prefix + '/ITC/manualCap')
+        response = await self.__request__(ENDPOINT_MANUAL_CAP, "PUT", full_url)
+
+        if response.status_code == 200:
+            # Разбор и запись кадра - в потоке, цикл событий не ждет диск
+            number, recognize = await asyncio.to_thread(self.__handle_manual_cap__, response.content, path,
+                                                        unrecognized_photo_save)
+            self.__on_recognition__(recognize)
+            if recognize:
+                logging.info("Detected, time %s: Number: %s", datetime.datetime.utcnow() - time_start, number)
+            else:
+                logging.debug("Manual Cup, time %s: Response: %s", datetime.datetime.utcnow() - time_start, number)
+            return number, recognize
+        return None, False
+
+    def __handle_manual_cap__(self, content, path, unrecognized_photo_save):
+        path = os.path.join(path, "manual_pictures")
+        if not os.path.exists(path):
+            os.mkdir(path)
+        return self.parse_message_from_byte(content, unrecognized_photo_save=unrecognized_photo_save,
+                                            download_path=path)
+
+    # Разбор бинарной посылки общий с синхронным клиентом
+    parse_message_from_byte = HikvisionClient.parse_message_from_byte
+    __handle_frame__ = HikvisionClient.__handle_frame__
+    __save_image_from_bytes__ = HikvisionClient.__save_image_from_bytes__
+    __record_fixation__ = HikvisionClient.__record_fixation__
+    __check_watchlist__ = HikvisionClient.__check_watchlist__
+    __on_disk_write__ = HikvisionClient.__on_disk_write__
+    __image_path__ = HikvisionClient.__image_path__
+    __on_image_written__ = HikvisionClient.__on_image_written__
+    enable_image_storage = HikvisionClient.enable_image_storage
+    __on_recognition__ = HikvisionClient.__on_recognition__
+    add_metrics_hook = HikvisionClient.add_metrics_hook
+    __on_request__ = HikvisionClient.__on_request__
+    # Водяной знак по времени камеры общий с синхронным клиентом
+    get_date_time_start = HikvisionClient.get_date_time_start
+    advance_watermark = HikvisionClient.advance_watermark
+    __move_watermark__ = HikvisionClient.__move_watermark__
+    __load_watermark__ = HikvisionClient.__load_watermark__
+    __save_watermark__ = HikvisionClient.__save_watermark__
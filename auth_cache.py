@@ -0,0 +1,52 @@
+import json
+import logging
+import os
+import threading
+
+AUTH_BASIC = "basic"
+AUTH_DIGEST = "digest"
+
+
+class AuthSchemeCache:
+    """Auth scheme (basic/digest) negotiated per host.
+    Kept in memory for the process and optionally in a small json file, so a warm start
+    sends the right Authorization with the first request.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._schemes = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._schemes = json.load(f)
+            except (OSError, ValueError):
+                logging.error(f"Can't load auth cache: {path}")
+
+    def get(self, host):
+        return self._schemes.get(host)
+
+    def set(self, host, scheme):
+        with self._lock:
+            if self._schemes.get(host) == scheme:
+                return
+            self._schemes[host] = scheme
+            self.__save__()
+
+    def forget(self, host):
+        with self._lock:
+            if self._schemes.pop(host, None) is not None:
+                self.__save__()
+
+    def __save__(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._schemes, f)
+        os.replace(tmp_path, self.path)
+
+
+# Общий кэш процесса, если клиенту не передали свой
+default_auth_cache = AuthSchemeCache()
@@ -0,0 +1,128 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+
+from hikvision_client import HikvisionClient
+from model import Fixation
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class Backfill:
+    """Recovers fixations of a past time range.
+    The range is split into windows of window seconds, up to concurrency windows are
+    searched and their metadata fetched at once. Finished windows are written to
+    checkpoint_path, so a restarted backfill of the same start skips them; the file is
+    removed when the range is complete. Fixations go through the client as in live
+    polling (known_play_uri, fixation_store, background download), and the end of a
+    complete range becomes the client watermark, live polling continues from there.
+    """
+
+    def __init__(self, client: HikvisionClient, time_start: datetime.datetime, time_end: datetime.datetime = None,
+                 window=600, concurrency=4, checkpoint_path=None):
+        self.client = client
+        # Чекпоинт хранит время с точностью до секунды
+        self.time_start = time_start.replace(microsecond=0)
+        self.time_end = (time_end or datetime.datetime.now()).replace(microsecond=0)
+        self.window = datetime.timedelta(seconds=window)
+        self.concurrency = concurrency
+        self.checkpoint_path = checkpoint_path
+        self.done = set()
+        self.fixations = 0
+        self._lock = threading.Lock()
+        self.__load__()
+
+    def windows(self) -> List[tuple]:
+        # Поиск включает оба конца, соседние окна не пересекаются на секунду
+        windows = []
+        start = self.time_start
+        while start < self.time_end:
+            end = min(start + self.window, self.time_end)
+            windows.append((start, end if end == self.time_end else end - datetime.timedelta(seconds=1)))
+            start = end
+        return windows
+
+    def run(self) -> List[Fixation]:
+        """Process every window not done yet, returns the new fixations in time order"""
+        windows = self.windows()
+        pending = [i for i in range(len(windows)) if i not in self.done]
+        logging.info(f"Backfill {self.client.host}: {self.time_start} - {self.time_end}, "
+                     f"windows: {len(pending)} of {len(windows)}")
+        fixations = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="backfill") as executor:
+            futures = {executor.submit(self.__window__, *windows[i]): i for i in pending}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    fixations.extend(future.result())
+                except Exception:
+                    # Окно не отмечено - повторится при следующем запуске
+                    logging.error(f"Backfill window failed: {windows[index][0]} - {windows[index][1]}")
+                    logging.debug(traceback.format_exc())
+                    continue
+                with self._lock:
+                    self.done.add(index)
+                    self.__save__()
+        if len(self.done) == len(windows):
+            self.__remove__()
+            self.client.advance_watermark(self.time_end)
+        fixations.sort(key=lambda f: f.date_time)
+        logging.info(f"Backfill {self.client.host} finished: {len(fixations)} fixations, "
+                     f"windows left: {len(windows) - len(self.done)}")
+        return fixations
+
+    def complete(self) -> bool:
+        return len(self.done) == len(self.windows())
+
+    def __window__(self, time_start, time_end) -> List[Fixation]:
+        client = self.client
+        fixations = []
+        for result in client.search(time_start=time_start, time_end=time_end, page_size=client.search_page_size):
+            if result.play_back_uri in client.known_play_uri:
+                continue
+            meta = client.__get_meta_data__(result.play_back_uri)
+            client.known_play_uri.add(result.play_back_uri, event_time=result.time_start_datetime.timestamp())
+            fixation = Fixation(url=result.play_back_uri, number=meta.number, date_time=result.time_start,
+                                color=meta.color, car_type=meta.type)
+            client.__dispatch_fixation__(fixation)
+            fixations.append(fixation)
+        with self._lock:
+            self.fixations += len(fixations)
+        logging.debug(f"Backfill window {time_start} - {time_end}: {len(fixations)} fixations")
+        return fixations
+
+    def __load__(self):
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint["time_start"] != self.time_start.strftime(TIME_FORMAT) or \
+                    checkpoint["window"] != self.window.total_seconds():
+                logging.info(f"Backfill checkpoint is for another range, ignored: {self.checkpoint_path}")
+                return
+            # Продолжаем тот же диапазон, новое время догонит обычный опрос
+            self.time_end = datetime.datetime.strptime(checkpoint["time_end"], TIME_FORMAT)
+            self.done = set(checkpoint["done"])
+        except (OSError, ValueError, KeyError):
+            logging.error(f"Can't load backfill checkpoint: {self.checkpoint_path}")
+
+    def __save__(self):
+        if self.checkpoint_path is None:
+            return
+        checkpoint = {"time_start": self.time_start.strftime(TIME_FORMAT),
+                      "time_end": self.time_end.strftime(TIME_FORMAT),
+                      "window": self.window.total_seconds(), "done": sorted(self.done)}
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def __remove__(self):
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
@@ -0,0 +1,160 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_camera import FakeCamera, FakeCameraConfig, AUTH_BASIC, AUTH_DIGEST
+from hikvision_client import HikvisionClient
+from seen_index import SeenIndex
+
+ALLOC_ITERATIONS = 5
+# Пик выделенной памяти на вызов в долях размера кадра: потоковые пути не держат кадр целиком,
+# manual_cup держит тело ответа и не больше пары копий
+ALLOC_LIMITS = {
+    "manual_cup": 4.0,
+    "manual_cup_stream": 1.5,
+    "download": 1.0,
+}
+DEFAULT_TOLERANCE = 0.25
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def measure(name, iterations, func, bytes_func=None):
+    """Run func iterations times, returns captures/sec, p50/p99 latency, allocated bytes and peak RSS"""
+    latencies = []
+    bytes_before = bytes_func() if bytes_func else 0
+    time_start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - time_start
+    bytes_received = (bytes_func() - bytes_before) if bytes_func else 0
+
+    # tracemalloc сильно замедляет вызовы, поэтому память меряем отдельным коротким проходом
+    tracemalloc.start()
+    for _ in range(min(iterations, ALLOC_ITERATIONS)):
+        func()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "bytes_received": bytes_received,
+        # Пик выделенной python памяти - оценка лишних копий payload
+        "alloc_peak_bytes": alloc_peak,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(args) -> list:
+    config = FakeCameraConfig(auth=args.auth, latency=args.latency, image_size=args.image_size,
+                              plate_ratio=args.plate_ratio, matches=args.matches)
+    work_dir = tempfile.mkdtemp(prefix="hik_bench_")
+    results = []
+    try:
+        with FakeCamera(config) as camera:
+            client = HikvisionClient(camera.url, config.login, config.password)
+
+            def sent():
+                return camera.bytes_sent
+
+            results.append(measure("manual_cup", args.iterations,
+                                   lambda: client.manual_cup(work_dir, unrecognized_photo_save=True), sent))
+            results.append(measure("manual_cup_stream", args.iterations,
+                                   lambda: client.manual_cup_stream(work_dir, unrecognized_photo_save=True), sent))
+
+            def get_pictures():
+                client.last_time = None
+                client.known_play_uri = SeenIndex()
+                client.get_pictures()
+
+            results.append(measure("get_pictures", max(1, args.iterations // 10), get_pictures, sent))
+
+            download_path = os.path.join(work_dir, "pictures")
+            os.mkdir(download_path)
+            results.append(measure("download", args.iterations,
+                                   lambda: client.__image_download__(download_path, "rtsp://fake/1", "1.jpg"), sent))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def check(results: list, image_size: int, baseline: list = None, tolerance=DEFAULT_TOLERANCE) -> list:
+    """Failed checks: allocation over ALLOC_LIMITS, and with a baseline (results of an earlier run)
+     ops/sec lower or allocation higher than the baseline by more than tolerance
+    """
+    failures = []
+    for r in results:
+        limit = ALLOC_LIMITS.get(r["name"])
+        if limit is not None and r["alloc_peak_bytes"] > limit * image_size:
+            failures.append(f"{r['name']}: alloc peak {r['alloc_peak_bytes']} > {limit} x image size {image_size}")
+    previous = {r["name"]: r for r in baseline or ()}
+    for r in results:
+        base = previous.get(r["name"])
+        if base is None:
+            continue
+        if r["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            failures.append(f"{r['name']}: {r['ops_per_sec']:.1f} ops/sec, baseline {base['ops_per_sec']:.1f}")
+        if r["alloc_peak_bytes"] > base["alloc_peak_bytes"] * (1 + tolerance):
+            failures.append(f"{r['name']}: alloc peak {r['alloc_peak_bytes']}, baseline {base['alloc_peak_bytes']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HikvisionClient benchmark against the fake ISAPI camera")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--auth", choices=(AUTH_BASIC, AUTH_DIGEST), default=AUTH_DIGEST)
+    parser.add_argument("--latency", type=float, default=0.0, help="camera latency, seconds")
+    parser.add_argument("--image-size", type=int, default=200 * 1024)
+    parser.add_argument("--plate-ratio", type=float, default=0.5)
+    parser.add_argument("--matches", type=int, default=50)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--baseline", help="json results of an earlier run with the same arguments to compare with")
+    parser.add_argument("--save-baseline", help="write the results as json for later --baseline runs")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed regression against the baseline, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    results = run(args)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'name':<20}{'ops/sec':>10}{'p50 ms':>10}{'p99 ms':>10}{'received':>12}{'alloc peak':>12}"
+              f"{'max rss kb':>12}")
+        for r in results:
+            print(f"{r['name']:<20}{r['ops_per_sec']:>10.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+                  f"{r['bytes_received']:>12}{r['alloc_peak_bytes']:>12}{r['max_rss_kb']:>12}")
+    failures = check(results, args.image_size, baseline, args.tolerance)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    # Ненулевой код выхода - для CI
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
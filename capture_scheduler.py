@@ -0,0 +1,101 @@
+import datetime
+import logging
+import threading
+import traceback
+
+from hikvision_client import HikvisionClient
+
+
+class CaptureScheduler:
+    """Adaptive manual_cup loop.
+    Captures back-to-back while plates are recognized, after idle_frames empty frames
+    the pause grows by backoff_factor up to max_interval. The pause never drops below
+    a share of the observed camera latency, max_interval can be set per hour of day
+    and trigger() (loop detector, alert event) wakes the loop at full rate.
+    """
+
+    def __init__(self, client: HikvisionClient, path, min_interval=0.0, max_interval=2.0, idle_frames=3,
+                 backoff_factor=2.0, initial_backoff=0.1, latency_factor=0.5, max_interval_by_hour=None,
+                 stream=False, unrecognized_photo_save=False):
+        self.client = client
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_frames = idle_frames
+        self.backoff_factor = backoff_factor
+        self.initial_backoff = initial_backoff
+        # Пауза не меньше latency_factor * средней задержки ответа камеры
+        self.latency_factor = latency_factor
+        # {час: max_interval}, например ночью реже
+        self.max_interval_by_hour = max_interval_by_hour or {}
+        self.stream = stream
+        self.unrecognized_photo_save = unrecognized_photo_save
+
+        self.interval = min_interval
+        self.latency = None
+        self.misses = 0
+        self.captures = 0
+        self.recognitions = 0
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def trigger(self):
+        """External trigger: capture now and go back to the full rate"""
+        self.misses = 0
+        self.interval = self.min_interval
+        self._wake.set()
+
+    def current_max_interval(self) -> float:
+        return self.max_interval_by_hour.get(datetime.datetime.now().hour, self.max_interval)
+
+    def capture(self):
+        time_start = datetime.datetime.now()
+        if self.stream:
+            number, recognize = self.client.manual_cup_stream(self.path,
+                                                              unrecognized_photo_save=self.unrecognized_photo_save)
+        else:
+            number, recognize = self.client.manual_cup(self.path, unrecognized_photo_save=self.unrecognized_photo_save)
+        latency = (datetime.datetime.now() - time_start).total_seconds()
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+        self.captures += 1
+        self.__adapt__(recognize)
+        return number, recognize
+
+    def __adapt__(self, recognize):
+        min_interval = max(self.min_interval, (self.latency or 0.0) * self.latency_factor)
+        if recognize:
+            self.recognitions += 1
+            self.misses = 0
+            self.interval = min_interval
+            return
+        self.misses += 1
+        if self.misses >= self.idle_frames:
+            self.interval = min(self.current_max_interval(),
+                                max(self.interval * self.backoff_factor, self.initial_backoff))
+        self.interval = max(self.interval, min_interval)
+
+    def run(self):
+        self._running = True
+        logging.info("Starting adaptive manual cup")
+        while self._running:
+            try:
+                self.capture()
+            except Exception:
+                logging.error(f"Manual cup failed, retry in {self.current_max_interval()}s")
+                logging.debug(traceback.format_exc())
+                self.interval = self.current_max_interval()
+            if self.interval > 0:
+                self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="capture-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
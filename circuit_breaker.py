@@ -0,0 +1,57 @@
+import logging
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of a request while the camera breaker is open"""
+
+
+class CircuitBreaker:
+    """Per-camera breaker: after failure_threshold consecutive failures all calls fail fast
+    for reset_timeout seconds, then a single probe is let through. Probe success closes it,
+    failure opens it again.
+    """
+
+    STATE_CLOSED = "closed"
+    STATE_OPEN = "open"
+    STATE_HALF_OPEN = "half_open"
+
+    def __init__(self, name="", failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.STATE_CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.STATE_CLOSED:
+                return True
+            if self.state == self.STATE_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.STATE_HALF_OPEN
+                logging.info(f"Circuit {self.name}: probing")
+                return True
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit open: {self.name}")
+
+    def success(self):
+        with self._lock:
+            if self.state != self.STATE_CLOSED:
+                logging.info(f"Circuit {self.name}: closed")
+            self.state = self.STATE_CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.STATE_OPEN:
+                    logging.error(f"Circuit {self.name}: open after {self.failures} failures")
+                self.state = self.STATE_OPEN
+                self._opened_at = time.monotonic()
@@ -0,0 +1,117 @@
+import datetime
+import logging
+import threading
+import time
+import traceback
+from typing import Any, Callable, Optional
+
+POLICY_FIRST = "first"
+POLICY_LAST = "last"
+POLICY_BEST = "best"
+
+
+class Passage:
+    """One vehicle passage: all hits of a plate on a camera closer than the window to each other"""
+    __slots__ = ("camera", "plate", "first_time", "last_time", "hits", "image", "payload", "score", "touched")
+
+    def __init__(self, camera: str, plate: str, date_time: datetime.datetime):
+        self.camera = camera
+        self.plate = plate
+        self.first_time = date_time
+        self.last_time = date_time
+        self.hits = 0
+        self.image = None
+        self.payload = None
+        self.score = None
+        # Локальное время последнего попадания, по нему закрываем проезд
+        self.touched = time.monotonic()
+
+    @property
+    def dwell(self) -> datetime.timedelta:
+        return self.last_time - self.first_time
+
+    def __repr__(self):
+        return f"Passage(camera={self.camera}, plate={self.plate}, hits={self.hits}, dwell={self.dwell})"
+
+
+class PlateCoalescer:
+    """Collapses repeated recognitions of one plate into a single Passage.
+    offer() keeps only the frame chosen by policy (first, last or best by score),
+    the passage is emitted to callback once no hit came for window seconds.
+    """
+
+    def __init__(self, callback: Callable[[Passage], None], window=5.0, policy=POLICY_BEST):
+        if policy not in (POLICY_FIRST, POLICY_LAST, POLICY_BEST):
+            raise ValueError(f"Unknown policy: {policy}")
+        self.callback = callback
+        self.window = datetime.timedelta(seconds=window)
+        self.policy = policy
+        self.offered = 0
+        self.emitted = 0
+        self._passages = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.__expire_loop__, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def offer(self, camera: str, plate: str, date_time: datetime.datetime = None, image: Optional[bytes] = None,
+              payload: Any = None, score: float = None):
+        date_time = date_time or datetime.datetime.now()
+        key = (camera, plate)
+        expired = None
+        with self._lock:
+            self.offered += 1
+            passage = self._passages.get(key)
+            if passage is not None and date_time - passage.last_time > self.window:
+                expired = self._passages.pop(key)
+                passage = None
+            if passage is None:
+                passage = self._passages[key] = Passage(camera, plate, date_time)
+            passage.hits += 1
+            passage.touched = time.monotonic()
+            passage.last_time = max(passage.last_time, date_time)
+            if self.__keep__(passage, score):
+                passage.image = image
+                passage.payload = payload
+                passage.score = score
+        if expired is not None:
+            self.__emit__(expired)
+
+    def __keep__(self, passage: Passage, score) -> bool:
+        if passage.hits == 1 or self.policy == POLICY_LAST:
+            return True
+        if self.policy == POLICY_FIRST:
+            return False
+        return score is not None and (passage.score is None or score > passage.score)
+
+    def expire(self):
+        """Emit passages without hits for window"""
+        border = time.monotonic() - self.window.total_seconds()
+        with self._lock:
+            expired = [key for key, p in self._passages.items() if p.touched < border]
+            passages = [self._passages.pop(key) for key in expired]
+        for passage in passages:
+            self.__emit__(passage)
+
+    def close(self):
+        """Stop the timer and emit everything still open"""
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            passages = list(self._passages.values())
+            self._passages.clear()
+        for passage in passages:
+            self.__emit__(passage)
+
+    def __emit__(self, passage: Passage):
+        self.emitted += 1
+        try:
+            self.callback(passage)
+        except Exception:
+            logging.error(f"Passage callback failed: {passage}")
+            logging.debug(traceback.format_exc())
+
+    def __expire_loop__(self):
+        interval = max(self.window.total_seconds() / 2, 0.1)
+        while not self._stop.wait(interval):
+            self.expire()
@@ -0,0 +1,265 @@
+import base64
+import datetime
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from manual_cap import MANUAL_CAP_IMAGE_OFFSET, MANUAL_CAP_PLATE_START, MANUAL_CAP_PLATE_END
+
+AUTH_BASIC = "basic"
+AUTH_DIGEST = "digest"
+
+DEVICE_INFO = """<?xml version="1.0" encoding="UTF-8"?>
+<DeviceInfo version="2.0" xmlns="http://www.isapi.org/ver20/XMLSchema">
+<deviceName>FakeCamera</deviceName>
+<deviceID>00000000-0000-0000-0000-000000000000</deviceID>
+<model>iDS-TCM203-A</model>
+<serialNumber>FAKE0000000000000000</serialNumber>
+<firmwareVersion>V0.0.0</firmwareVersion>
+<firmwareReleasedDate>build 000000</firmwareReleasedDate>
+<deviceType>IPCamera</deviceType>
+</DeviceInfo>
+"""
+
+RESPONSE_STATUS_OK = b"""<?xml version="1.0" encoding="UTF-8"?>
+<ResponseStatus><statusCode>1</statusCode><statusString>OK</statusString></ResponseStatus>
+""".ljust(272, b"\x00")
+
+MATCH_ITEM = """<searchMatchItem>
+<sourceID>{{0000000000-0000-0000-0000-000000000000}}</sourceID>
+<trackID>120</trackID>
+<timeSpan>
+<startTime>{time}</startTime>
+<endTime>{time}</endTime>
+</timeSpan>
+<mediaSegmentDescriptor>
+<contentType>video</contentType>
+<codecType>H.264-BP</codecType>
+<playbackURI>rtsp://fake/Streaming/tracks/120?starttime={time}&amp;endtime={time}&amp;name={name}&amp;size={size}</playbackURI>
+</mediaSegmentDescriptor>
+<metadataMatches>
+<metadataDescriptor>recordType.meta.hikvision.com/timing</metadataDescriptor>
+</metadataMatches>
+</searchMatchItem>
+"""
+
+SEARCH_RESULT = """<?xml version="1.0" encoding="UTF-8"?>
+<CMSearchResult version="1.0" xmlns="urn:psialliance-org">
+<searchID>{search_id}</searchID>
+<responseStatus>true</responseStatus>
+<numOfMatches>{count}</numOfMatches>
+<responseStatusStrg>{status}</responseStatusStrg>
+<matchList>
+{items}</matchList>
+</CMSearchResult>
+"""
+
+PICTURE_INFORMATION = """<?xml version="1.0" encoding="UTF-8"?>
+<PictureInformation version="2.0" xmlns="http://www.isapi.org/ver20/XMLSchema">
+<plateNumber>{number}</plateNumber>
+<plateColor>white</plateColor>
+<carType>vehicle</carType>
+</PictureInformation>
+"""
+
+CAMERA_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class FakeCameraConfig:
+    def __init__(self, login="user", password="password", auth=AUTH_DIGEST, latency=0.0, image_size=200 * 1024,
+                 plate_ratio=0.5, status_ratio=0.0, matches=20, match_interval=5, plate_image_size=0):
+        self.login = login
+        self.password = password
+        self.auth = auth
+        # Задержка ответа камеры, секунды
+        self.latency = latency
+        self.image_size = image_size
+        # Доля кадров с номером, остальные unknown
+        self.plate_ratio = plate_ratio
+        # Доля ответов manualCap с 272 байтным ResponseStatus
+        self.status_ratio = status_ratio
+        # Сколько фиксаций в окне поиска и через сколько секунд друг от друга
+        self.matches = matches
+        self.match_interval = match_interval
+        # Вырезка номера после кадра в manualCap, 0 - без нее
+        self.plate_image_size = plate_image_size
+
+
+class FakeCamera:
+    """In-process stand-in for an ITC camera ISAPI.
+    Serves deviceInfo, ContentMgmt search with MORE paging, pictureInformation, download
+    and the binary manualCap frame on 127.0.0.1.
+    """
+
+    def __init__(self, config: FakeCameraConfig = None, host="127.0.0.1", port=0):
+        self.config = config or FakeCameraConfig()
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._nonce = uuid.uuid4().hex
+        self._random = random.Random(0)
+        self._image = _jpeg(self.config.image_size)
+        self._plate_image = _jpeg(self.config.plate_image_size) if self.config.plate_image_size else b""
+        self._matches = self.__make_matches__()
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        # Клиент с коротким таймаутом рвет соединение - это не ошибка камеры
+        self.server.handle_error = lambda request, address: logging.debug(f"Fake camera: {address} disconnected")
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-camera", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __make_matches__(self):
+        now = datetime.datetime.now()
+        matches = []
+        for i in range(self.config.matches):
+            match_time = (now - datetime.timedelta(seconds=self.config.match_interval * (self.config.matches - i)))
+            matches.append((match_time.strftime(CAMERA_TIME_FORMAT), f"{i:08d}_SC_01"))
+        return matches
+
+    def __plate__(self) -> str:
+        with self._lock:
+            value = self._random.random()
+        return f"A{self._random.randint(100, 999)}BC77" if value < self.config.plate_ratio else "unknown"
+
+    def check_auth(self, method: str, path: str, header: str) -> bool:
+        if not header:
+            return False
+        if self.config.auth == AUTH_BASIC:
+            expected = base64.b64encode(f"{self.config.login}:{self.config.password}".encode()).decode()
+            return header == f"Basic {expected}"
+        if not header.startswith("Digest "):
+            return False
+        params = dict(re.findall(r'(\w+)="?([^",]*)"?', header[7:]))
+        ha1 = _md5(f"{self.config.login}:{_REALM}:{self.config.password}")
+        ha2 = _md5(f"{method}:{params.get('uri', path)}")
+        if params.get("qop"):
+            response = _md5(f"{ha1}:{params.get('nonce')}:{params.get('nc')}:{params.get('cnonce')}:"
+                            f"{params.get('qop')}:{ha2}")
+        else:
+            response = _md5(f"{ha1}:{params.get('nonce')}:{ha2}")
+        return params.get("username") == self.config.login and params.get("response") == response
+
+    def challenge(self) -> str:
+        if self.config.auth == AUTH_BASIC:
+            return f'Basic realm="{_REALM}"'
+        return f'Digest realm="{_REALM}", qop="auth", nonce="{self._nonce}", algorithm="MD5"'
+
+    def search(self, body: str) -> bytes:
+        search_id = _tag(body, "searchID") or str(uuid.uuid4())
+        start = _tag(body, "startTime") or ""
+        end = _tag(body, "endTime") or "9999"
+        count = int(_tag(body, "maxResults") or 20)
+        position = int(_tag(body, "searchResultPostion") or 0)
+        found = [m for m in self._matches if start <= m[0] <= end]
+        page = found[position:position + count]
+        items = "".join(MATCH_ITEM.format(time=t, name=name, size=self.config.image_size) for t, name in page)
+        status = "MORE" if position + len(page) < len(found) else "OK"
+        return SEARCH_RESULT.format(search_id=search_id, count=len(page), status=status, items=items).encode()
+
+    def picture_information(self) -> bytes:
+        return PICTURE_INFORMATION.format(number=self.__plate__()).encode()
+
+    def download(self) -> bytes:
+        return self._image
+
+    def manual_cap(self) -> bytes:
+        with self._lock:
+            status = self._random.random() < self.config.status_ratio
+        if status:
+            return RESPONSE_STATUS_OK
+        header = bytearray(MANUAL_CAP_IMAGE_OFFSET)
+        plate = self.__plate__().encode()
+        header[MANUAL_CAP_PLATE_START:MANUAL_CAP_PLATE_START + len(plate)] = plate[:MANUAL_CAP_PLATE_END -
+                                                                                   MANUAL_CAP_PLATE_START]
+        return bytes(header) + self._image + self._plate_image
+
+
+_REALM = "FakeCamera"
+
+
+def _jpeg(size: int) -> bytes:
+    return b"\xff\xd8\xff\xe0" + bytes(max(size - 6, 0)) + b"\xff\xd9"
+
+
+def _md5(value: str) -> str:
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def _tag(body: str, name: str):
+    match = re.search(f"<{name}>\\s*(.*?)\\s*</{name}>", body, re.S)
+    return match.group(1) if match else None
+
+
+def _handler(camera: FakeCamera):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logging.debug("Fake camera: " + format % args)
+
+        def __reply__(self, code, body: bytes, content_type="application/xml", headers=None):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+            with camera._lock:
+                camera.requests += 1
+                camera.bytes_sent += len(body)
+
+        def __handle__(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode(errors="replace") if length else ""
+            if not camera.check_auth(self.command, self.path, self.headers.get("Authorization")):
+                self.__reply__(401, b"", headers={"WWW-Authenticate": camera.challenge()})
+                return
+            if camera.config.latency:
+                time.sleep(camera.config.latency)
+            path = self.path.split("?", 1)[0]
+            if path.endswith("/System/deviceInfo"):
+                self.__reply__(200, DEVICE_INFO.encode())
+            elif path.endswith("/ContentMgmt/search"):
+                self.__reply__(200, camera.search(body))
+            elif path.endswith("/ITC/ContentMgmt/pictureInformation"):
+                self.__reply__(200, camera.picture_information())
+            elif path.endswith("/ITC/ContentMgmt/download"):
+                self.__reply__(200, camera.download(), content_type="image/jpeg")
+            elif path.endswith("/ITC/manualCap"):
+                self.__reply__(200, camera.manual_cap(), content_type="application/octet-stream")
+            else:
+                self.__reply__(404, b"")
+
+        do_GET = __handle__
+        do_POST = __handle__
+        do_PUT = __handle__
+
+    return Handler
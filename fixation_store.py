@@ -0,0 +1,163 @@
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+from typing import List, Optional, Union
+
+from model import Fixation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fixation (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    time TEXT NOT NULL,
+    plate TEXT,
+    color TEXT,
+    car_type TEXT,
+    image_path TEXT,
+    url TEXT,
+    hits INTEGER,
+    dwell REAL
+);
+CREATE INDEX IF NOT EXISTS fixation_plate_time ON fixation (plate, time);
+CREATE INDEX IF NOT EXISTS fixation_time ON fixation (time);
+"""
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+CAMERA_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Колонки, добавленные после первой версии схемы
+_ADDED_COLUMNS = (("hits", "INTEGER"), ("dwell", "REAL"))
+
+
+def _to_time(value: Union[str, datetime.datetime]) -> str:
+    if isinstance(value, datetime.datetime):
+        return value.strftime(TIME_FORMAT)
+    return datetime.datetime.strptime(value, CAMERA_TIME_FORMAT).strftime(TIME_FORMAT)
+
+
+class FixationRecord:
+    """hits and dwell (seconds) are set for a coalesced passage, None for a single recognition"""
+    __slots__ = ("camera", "time", "plate", "color", "car_type", "image_path", "url", "hits", "dwell")
+
+    def __init__(self, camera, time, plate, color=None, car_type=None, image_path=None, url=None, hits=None,
+                 dwell=None):
+        self.camera = camera
+        self.time = time
+        self.plate = plate
+        self.color = color
+        self.car_type = car_type
+        self.image_path = image_path
+        self.url = url
+        self.hits = hits
+        self.dwell = dwell
+
+    def __repr__(self):
+        return f"FixationRecord(camera={self.camera}, time={self.time}, plate={self.plate})"
+
+
+class FixationStore:
+    """SQLite journal of fixations with plate and time indexes.
+    add() only puts the record in a queue, a writer thread inserts them in batches,
+    one transaction per batch, at most flush_interval seconds after the first record of the batch.
+    """
+
+    def __init__(self, path, batch_size=200, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        connection = self.__connection__()
+        connection.executescript(SCHEMA)
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(fixation)")}
+        for name, column_type in _ADDED_COLUMNS:
+            if name not in columns:
+                connection.execute(f"ALTER TABLE fixation ADD COLUMN {name} {column_type}")
+        connection.commit()
+        self._thread = threading.Thread(target=self.__writer__, name="fixation-store", daemon=True)
+        self._thread.start()
+
+    def __connection__(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def add(self, camera: str, date_time: Union[str, datetime.datetime], plate: str, color=None, car_type=None,
+            image_path=None, url=None, hits=None, dwell=None):
+        self._queue.put((camera, _to_time(date_time), plate, color, car_type, image_path, url, hits, dwell))
+
+    def add_fixation(self, camera: str, fixation: Fixation, image_path=None, hits=None, dwell=None):
+        self.add(camera, fixation.date_time, fixation.number, fixation.color, fixation.car_type, image_path,
+                 fixation.url, hits, dwell)
+
+    def flush(self):
+        """Wait until everything added so far is written"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def __writer__(self):
+        connection = self.__connection__()
+        while True:
+            batch = [self._queue.get()]
+            # Срок партии считаем от первой записи, а не от последней
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while batch[-1] is not None and len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            stop = batch[-1] is None
+            rows = [row for row in batch if row is not None]
+            try:
+                if rows:
+                    with connection:
+                        connection.executemany(
+                            "INSERT INTO fixation (camera, time, plate, color, car_type, image_path, url, hits, dwell) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error:
+                logging.error(f"Fixation store: can't write {len(rows)} rows")
+                logging.debug(traceback.format_exc())
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                connection.close()
+                return
+
+    def __query__(self, where: str, args: tuple, limit: Optional[int]) -> List[FixationRecord]:
+        sql = f"SELECT camera, time, plate, color, car_type, image_path, url, hits, dwell FROM fixation " \
+              f"WHERE {where} ORDER BY time"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [FixationRecord(*row) for row in self.__connection__().execute(sql, args)]
+
+    def find_by_plate(self, plate: str, time_start=None, time_end=None, limit=None) -> List[FixationRecord]:
+        where, args = "plate = ?", (plate,)
+        if time_start is not None:
+            where, args = where + " AND time >= ?", args + (_to_time(time_start),)
+        if time_end is not None:
+            where, args = where + " AND time < ?", args + (_to_time(time_end),)
+        return self.__query__(where, args, limit)
+
+    def find_by_prefix(self, prefix: str, limit=None) -> List[FixationRecord]:
+        # Диапазон вместо LIKE, чтобы работал индекс по plate
+        return self.__query__("plate >= ? AND plate < ?", (prefix, prefix + "\U0010ffff"), limit)
+
+    def find_by_time(self, time_start, time_end, camera=None, limit=None) -> List[FixationRecord]:
+        where, args = "time >= ? AND time < ?", (_to_time(time_start), _to_time(time_end))
+        if camera is not None:
+            where, args = where + " AND camera = ?", args + (camera,)
+        return self.__query__(where, args, limit)
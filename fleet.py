@@ -0,0 +1,188 @@
+import heapq
+import itertools
+import logging
+import os.path
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from auth_cache import AuthSchemeCache, default_auth_cache
+from hikvision_client import HikvisionClient
+
+
+class CameraConfig:
+    MODE_MANUAL_CUP = "manual_cup"
+    MODE_SEARCH = "search"
+
+    def __init__(self, host, login=None, password=None, mode=MODE_MANUAL_CUP, interval=0.0, path=None,
+                 unrecognized_photo_save=False):
+        self.host = host
+        self.login = login
+        self.password = password
+        self.mode = mode
+        self.interval = float(interval)
+        self.path = path if path is not None else os.path.abspath(os.curdir)
+        self.unrecognized_photo_save = unrecognized_photo_save
+
+
+class _CameraState:
+    def __init__(self, config: CameraConfig):
+        self.config = config
+        self.client = None
+        self.removed = False
+        self.errors = 0
+
+
+class FleetPoller:
+    """Runs manual_cup / get_pictures loops for many cameras on a bounded thread pool.
+    Every camera has at most one task in flight and is scheduled by its next due time,
+    so a slow or dead camera only holds one worker and backs off on errors.
+    With auth_cache_path the negotiated auth scheme of every camera survives a restart.
+    """
+
+    ERROR_BACKOFF_MIN = 1.0
+    ERROR_BACKOFF_MAX = 60.0
+
+    def __init__(self, max_workers=8, stats_window=60.0, auth_cache_path=None):
+        self.max_workers = max_workers
+        self.auth_cache = AuthSchemeCache(auth_cache_path) if auth_cache_path is not None else default_auth_cache
+        self.stats_window = float(stats_window)
+        self.cameras = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(max_workers)
+        self._executor = None
+        self._thread = None
+        self._running = False
+        self._captures = deque()
+        self._recognitions = deque()
+        self.total_captures = 0
+        self.total_recognitions = 0
+
+    def add_camera(self, config: CameraConfig):
+        with self._cond:
+            if config.host in self.cameras:
+                raise ValueError(f"Camera already added: {config.host}")
+            state = _CameraState(config)
+            self.cameras[config.host] = state
+            heapq.heappush(self._queue, (time.monotonic(), next(self._seq), state))
+            self._cond.notify()
+        logging.info(f"Fleet: camera added {config.host}, mode: {config.mode}")
+
+    def remove_camera(self, host):
+        with self._cond:
+            state = self.cameras.pop(host, None)
+            if state is not None:
+                state.removed = True
+            # Камера в очереди - закрываем сразу, иначе после текущей задачи в __run__
+            idle = state is not None and any(entry[2] is state for entry in self._queue)
+            self._cond.notify()
+        if idle:
+            self.__close_client__(state)
+        logging.info(f"Fleet: camera removed {host}")
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fleet")
+        self._thread = threading.Thread(target=self.__scheduler__, daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            self.__trim__(now)
+            return {
+                "cameras": len(self.cameras),
+                "captures_per_sec": len(self._captures) / self.stats_window,
+                "recognitions_per_sec": len(self._recognitions) / self.stats_window,
+                "total_captures": self.total_captures,
+                "total_recognitions": self.total_recognitions,
+            }
+
+    def __trim__(self, now):
+        border = now - self.stats_window
+        while self._captures and self._captures[0] < border:
+            self._captures.popleft()
+        while self._recognitions and self._recognitions[0] < border:
+            self._recognitions.popleft()
+
+    def __scheduler__(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                _, _, state = heapq.heappop(self._queue)
+                if state.removed:
+                    continue
+            # Ждем свободный воркер, чтобы не копить задачи в очереди пула
+            self._slots.acquire()
+            try:
+                self._executor.submit(self.__run__, state)
+            except RuntimeError:
+                self._slots.release()
+                return
+
+    def __run__(self, state: _CameraState):
+        config = state.config
+        delay = config.interval
+        try:
+            if state.client is None:
+                state.client = HikvisionClient(config.host, config.login, config.password,
+                                               auth_cache=self.auth_cache)
+            if config.mode == CameraConfig.MODE_SEARCH:
+                recognized = len(state.client.get_pictures())
+            else:
+                _, recognize = state.client.manual_cup(config.path,
+                                                       unrecognized_photo_save=config.unrecognized_photo_save)
+                recognized = 1 if recognize else 0
+            state.errors = 0
+            self.__count__(recognized)
+        except Exception:
+            state.errors += 1
+            delay = min(self.ERROR_BACKOFF_MIN * 2 ** (state.errors - 1), self.ERROR_BACKOFF_MAX)
+            logging.error(f"Fleet: camera {config.host} failed {state.errors} times, retry in {delay}s")
+            logging.debug(traceback.format_exc())
+        finally:
+            self._slots.release()
+            with self._cond:
+                removed = state.removed
+                if not removed:
+                    heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), state))
+                    self._cond.notify()
+            if removed:
+                self.__close_client__(state)
+
+    @staticmethod
+    def __close_client__(state: _CameraState):
+        if state.client is not None:
+            state.client.close()
+            state.client = None
+
+    def __count__(self, recognized):
+        with self._cond:
+            now = time.monotonic()
+            self._captures.append(now)
+            self.total_captures += 1
+            for _ in range(recognized):
+                self._recognitions.append(now)
+            self.total_recognitions += recognized
+            self.__trim__(now)
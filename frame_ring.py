@@ -0,0 +1,227 @@
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+POLICY_OVERWRITE = "overwrite"
+POLICY_DROP = "drop"
+
+MAX_READERS = 8
+_INACTIVE = 2 ** 64 - 1
+_MAGIC = 0x48494B52
+
+# magic, version, capacity, index slots, write seq, write pos, позиции читателей
+_HEADER = struct.Struct("<IIQQQQ")
+_READERS = struct.Struct(f"<{MAX_READERS}Q")
+_HEADER_SIZE = 128
+_OFFSET_SEQ = 24
+_OFFSET_POS = 32
+# seq, pos, length, timestamp, camera, plate
+_RECORD = struct.Struct("<QQQd64s32s")
+# Кольца, созданные этим процессом
+_created = set()
+
+
+class Frame:
+    """One frame of the ring: data is a memoryview into shared memory, not a copy"""
+    __slots__ = ("seq", "pos", "camera", "plate", "timestamp", "data")
+
+    def __init__(self, seq, pos, camera, plate, timestamp, data: memoryview):
+        self.seq = seq
+        self.pos = pos
+        self.camera = camera
+        self.plate = plate
+        self.timestamp = timestamp
+        self.data = data
+
+    def __repr__(self):
+        return f"Frame(seq={self.seq}, camera={self.camera}, plate={self.plate}, size={len(self.data)})"
+
+
+class _Ring:
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buf = shm.buf
+        magic, _, self.capacity, self.slots, _, _ = _HEADER.unpack_from(self.buf, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"Not a frame ring: {shm.name}")
+        self.index_offset = _HEADER_SIZE
+        self.data_offset = _HEADER_SIZE + self.slots * _RECORD.size
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write_seq(self) -> int:
+        return struct.unpack_from("<Q", self.buf, _OFFSET_SEQ)[0]
+
+    def write_pos(self) -> int:
+        return struct.unpack_from("<Q", self.buf, _OFFSET_POS)[0]
+
+    def reader_positions(self):
+        return _READERS.unpack_from(self.buf, _HEADER.size)
+
+    def set_reader_position(self, reader_id, pos):
+        struct.pack_into("<Q", self.buf, _HEADER.size + reader_id * 8, pos)
+
+    def record(self, seq):
+        return _RECORD.unpack_from(self.buf, self.index_offset + (seq % self.slots) * _RECORD.size)
+
+
+class FrameRing(_Ring):
+    """Shared memory ring of captured frames for other processes.
+    The capture process is the only writer: put() copies the image once into the data area and
+    publishes (camera, plate, timestamp, offset, length) in a fixed index of slots records.
+    Readers attach by name with FrameRingReader. POLICY_OVERWRITE never blocks capture, slow
+    readers lose old frames; POLICY_DROP refuses new frames while a registered reader still
+    has not released the space they need.
+    """
+
+    def __init__(self, name=None, size=64 * 1024 * 1024, slots=1024, policy=POLICY_OVERWRITE):
+        if policy not in (POLICY_OVERWRITE, POLICY_DROP):
+            raise ValueError(f"Unknown policy: {policy}")
+        shm = shared_memory.SharedMemory(name=name, create=True, size=_HEADER_SIZE + slots * _RECORD.size + size)
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, 1, size, slots, 0, 0)
+        _READERS.pack_into(shm.buf, _HEADER.size, *([_INACTIVE] * MAX_READERS))
+        _created.add(shm.name)
+        super().__init__(shm)
+        self.policy = policy
+        self.written = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, camera: str, plate: str, data, timestamp: float = None) -> Optional[int]:
+        """Copy data into the ring, returns its sequence number or None if it was dropped"""
+        length = len(data)
+        if length > self.capacity:
+            logging.error(f"Frame ring: frame of {length} bytes does not fit {self.capacity}")
+            return None
+        with self._lock:
+            seq = self.write_seq()
+            pos = self.write_pos()
+            offset = pos % self.capacity
+            if offset + length > self.capacity:
+                # Кадр не режем: хвост пропускаем, пишем с начала
+                pos += self.capacity - offset
+                offset = 0
+            if self.policy == POLICY_DROP and not self.__has_space__(pos + length, seq):
+                self.dropped += 1
+                return None
+            start = self.data_offset + offset
+            self.buf[start:start + length] = data
+            _RECORD.pack_into(self.buf, self.index_offset + (seq % self.slots) * _RECORD.size, seq, pos, length,
+                              timestamp or time.time(), camera.encode()[:64], plate.encode()[:32])
+            # Позиция и номер публикуются последними - читатель видит только записанный кадр
+            struct.pack_into("<Q", self.buf, _OFFSET_POS, pos + length)
+            struct.pack_into("<Q", self.buf, _OFFSET_SEQ, seq + 1)
+            self.written += 1
+        return seq
+
+    def __has_space__(self, end_pos, seq) -> bool:
+        for reader_pos, reader_seq in self.__readers__():
+            if end_pos - reader_pos > self.capacity or seq - reader_seq >= self.slots:
+                return False
+        return True
+
+    def __readers__(self):
+        # Читатель хранит номер следующего кадра, позиция - начало этого кадра
+        for value in self.reader_positions():
+            if value == _INACTIVE:
+                continue
+            if value >= self.write_seq():
+                yield self.write_pos(), value
+            else:
+                yield self.record(value)[1], value
+
+    def close(self):
+        """Release and remove the shared memory, readers keep their mapping until they close"""
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        _created.discard(self.shm.name)
+
+
+class FrameRingReader(_Ring):
+    """Reader of a FrameRing in another process.
+    read() returns frames in order; the memoryview of a frame stays valid until the next read()
+    with reader_id (backpressure for POLICY_DROP) or until valid() turns False with POLICY_OVERWRITE.
+    Every process reading with backpressure needs its own reader_id below MAX_READERS.
+    """
+
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, name, reader_id: int = None):
+        super().__init__(_attach(name))
+        if reader_id is not None and not 0 <= reader_id < MAX_READERS:
+            raise ValueError(f"reader_id must be below {MAX_READERS}")
+        self.reader_id = reader_id
+        self.next_seq = self.write_seq()
+        self.lost = 0
+        self._frame = None
+        if reader_id is not None:
+            self.set_reader_position(reader_id, self.next_seq)
+
+    def read(self, timeout: float = None) -> Optional[Frame]:
+        """Next frame, waits up to timeout (None - forever), None on timeout"""
+        self.release()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            write_seq = self.write_seq()
+            if self.next_seq >= write_seq:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            if write_seq - self.next_seq > self.slots:
+                # Отстали больше, чем помещается в индексе
+                self.lost += write_seq - self.slots - self.next_seq
+                self.next_seq = write_seq - self.slots
+            seq, pos, length, timestamp, camera, plate = self.record(self.next_seq)
+            if seq == self.next_seq and self.write_pos() - pos <= self.capacity:
+                break
+            # Кадр уже перезаписан
+            self.lost += 1
+            self.next_seq += 1
+        start = self.data_offset + pos % self.capacity
+        self._frame = Frame(seq, pos, camera.rstrip(b"\x00").decode(errors="replace"),
+                            plate.rstrip(b"\x00").decode(errors="replace"), timestamp,
+                            self.buf[start:start + length])
+        self.next_seq = seq + 1
+        return self._frame
+
+    def valid(self, frame: Frame) -> bool:
+        """False once the writer has started to overwrite the frame data"""
+        return self.write_pos() - frame.pos <= self.capacity
+
+    def release(self):
+        """Give the space of the last read frame back to the writer"""
+        if self._frame is not None:
+            self._frame.data.release()
+            self._frame = None
+        if self.reader_id is not None:
+            self.set_reader_position(self.reader_id, self.next_seq)
+
+    def close(self):
+        self.release()
+        if self.reader_id is not None:
+            self.set_reader_position(self.reader_id, _INACTIVE)
+        self.buf = None
+        self.shm.close()
+
+
+def _attach(name) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # До 3.13 трекер отдельного процесса удалит чужой сегмент при выходе читателя.
+        # Дочерние процессы multiprocessing делят трекер с родителем, как и читатель в процессе писателя
+        if multiprocessing.parent_process() is None and shm.name not in _created:
+            try:
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+        return shm
@@ -1,21 +1,38 @@
 import datetime
+import itertools
 import logging
 import os.path
-import shutil
+import queue
+import random
+import re
 import time
 import traceback
 import urllib
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from threading import Thread
 from time import sleep
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
 import requests
-import xmltodict
+import urllib3
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth, HTTPDigestAuth
 from urllib.parse import urljoin
 
-from model import DeviceInfo, CMSearchResult, PictureInformation, Fixation
+from auth_cache import AuthSchemeCache, AUTH_BASIC, AUTH_DIGEST, default_auth_cache
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from coalescer import PlateCoalescer, Passage, POLICY_BEST
+from image_storage import ImageStorage
+from manual_cap import ManualCapFrame, JpegEndScanner, decode_frame, decode_header, MANUAL_CAP_IMAGE_OFFSET, \
+    UNKNOWN_PLATE, JPEG_SOI
+from payload_log import PayloadLog
+from metrics import MetricsHook, ENDPOINT_DEVICE_INFO, ENDPOINT_SEARCH, ENDPOINT_PICTURE_INFORMATION, \
+    ENDPOINT_DOWNLOAD, ENDPOINT_MANUAL_CAP, STATUS_TIMEOUT, STATUS_ERROR, STATUS_CIRCUIT_OPEN
+from seen_index import SeenIndex
+from model import DeviceInfo, CMSearchResult, PictureInformation, Fixation, SearchMatchItem
 
 
 def human_size(bytes, units=[' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB']):
@@ -23,51 +40,327 @@ def human_size(bytes, units=[' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB']):
     return str(bytes) + units[0] if bytes < 1024 else human_size(bytes >> 10, units[1:])
 
 
+STREAM_CHUNK_SIZE = 64 * 1024
+# Номер из ответа камеры попадает в имя файла
+_UNSAFE_NAME = re.compile(r"[^\w-]")
+
+
+def _safe_name(plate) -> str:
+    """Plate for a file name: path separators and other unsafe characters become _"""
+    return _UNSAFE_NAME.sub("_", str(plate)) or UNKNOWN_PLATE
+
+
+def _auth_scheme(request) -> str:
+    """Scheme the request was sent with, None if it had no Authorization header"""
+    header = request.headers.get("Authorization", "") if request is not None else ""
+    if header.startswith("Digest"):
+        return AUTH_DIGEST
+    if header.startswith("Basic"):
+        return AUTH_BASIC
+    return None
+
+
+def _read_into(raw, view: memoryview) -> int:
+    """Fill the view from raw until it is full or the stream ends"""
+    size = 0
+    while size < len(view):
+        n = raw.readinto(view[size:])
+        if not n:
+            break
+        size += n
+    return size
+
+
+def _copy_stream(raw, f) -> Tuple[int, float]:
+    """Copy raw to f through one reused buffer, returns bytes written and seconds spent in write"""
+    buffer = memoryview(bytearray(STREAM_CHUNK_SIZE))
+    written = 0
+    write_time = 0.0
+    while True:
+        n = raw.readinto(buffer)
+        if not n:
+            break
+        time_start = time.perf_counter()
+        f.write(buffer[:n])
+        write_time += time.perf_counter() - time_start
+        written += n
+    return written, write_time
+
+
+def _jpeg_pieces(raw, head: bytearray, start, end) -> Iterator[Tuple[bool, memoryview]]:
+    """Pieces of every JPEG in head[start:end] and then in raw, bytes between the images are skipped.
+     Yields (first piece of a new image, piece); a piece of raw is only valid until the next one
+    """
+    buffer = bytearray(STREAM_CHUNK_SIZE)
+    scanner = None
+    carry = b""
+    data, position, size = head, start, end
+    while True:
+        while position < size:
+            new = False
+            if scanner is None:
+                if carry:
+                    # SOI мог разрезаться между кусками
+                    joined = carry + bytes(data[position:position + len(JPEG_SOI) - 1])
+                    soi = joined.find(JPEG_SOI)
+                    if 0 <= soi < len(carry):
+                        scanner = JpegEndScanner()
+                        piece = joined[soi:len(carry)]
+                        scanner.feed(piece)
+                        carry = b""
+                        yield True, memoryview(piece)
+                        continue
+                soi = data.find(JPEG_SOI, position, size)
+                if soi < 0:
+                    carry = (carry + bytes(data[max(position, size - len(JPEG_SOI) + 1):size]))[1 - len(JPEG_SOI):]
+                    break
+                carry = b""
+                scanner = JpegEndScanner()
+                position = soi
+                new = True
+            image_end = scanner.feed(data, position, size)
+            stop = size if image_end < 0 else image_end
+            yield new, memoryview(data)[position:stop]
+            position = stop
+            if image_end >= 0:
+                scanner = None
+        size = raw.readinto(buffer)
+        if not size:
+            return
+        data, position = buffer, 0
+
+
+def _read_jpegs(raw, head: bytearray, start, end) -> List[bytes]:
+    images = []
+    for new, piece in _jpeg_pieces(raw, head, start, end):
+        if new:
+            images.append(bytearray())
+        images[-1] += piece
+    return [bytes(image) for image in images]
+
+
+def _drain(raw):
+    """Read the stream to the end through one reused buffer, without keeping the data"""
+    buffer = memoryview(bytearray(STREAM_CHUNK_SIZE))
+    while raw.readinto(buffer):
+        pass
+
+
+# (connect, read) таймауты по endpoint, connect подставляется из timeout клиента
+DEFAULT_READ_TIMEOUTS = {
+    ENDPOINT_DEVICE_INFO: 3.0,
+    ENDPOINT_SEARCH: 10.0,
+    ENDPOINT_PICTURE_INFORMATION: 5.0,
+    ENDPOINT_DOWNLOAD: 30.0,
+    ENDPOINT_MANUAL_CAP: 10.0,
+}
+# manualCap делает новый снимок, его не повторяем
+IDEMPOTENT_ENDPOINTS = frozenset((ENDPOINT_DEVICE_INFO, ENDPOINT_SEARCH, ENDPOINT_PICTURE_INFORMATION))
+
+
 class HikvisionClient:
-    def __init__(self, host, login=None, password=None, timeout=3, isapi_prefix='ISAPI'):
+    def __init__(self, host, login=None, password=None, timeout=3, isapi_prefix='ISAPI', known_play_uri_path=None,
+                 metadata_concurrency=4, auth_cache: AuthSchemeCache = None, pool_size=None, watermark_path=None):
         self.host = host
         self.login = login
         self.password = password
         self.timeout = float(timeout)
         self.isapi_prefix = isapi_prefix
-        self.req = self._check_session()
+        # Сессия и схема авторизации создаются при первом запросе
+        self.auth_cache = auth_cache if auth_cache is not None else default_auth_cache
+        self.pool_size = pool_size if pool_size is not None else metadata_concurrency + 4
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._auth_negotiated = False
+        self._auth_lock = threading.Lock()
         self.count_events = 1
         self.last_time = None
-        self.known_play_uri = []
+        self.known_play_uri = SeenIndex(path=known_play_uri_path)
+        # Водяной знак опроса на диске, после перезапуска поиск продолжается с него
+        self.watermark_path = watermark_path
+        # Без новых совпадений водяной знак сдвигается к концу окна минус запас (больше расхождения часов)
+        self.watermark_margin = 60
+        self.__load_watermark__()
+        self.search_page_size = 20
+        self.metadata_concurrency = metadata_concurrency
+        self.metadata_executor = None
+        self.fixation_store = None
+        self.coalescer = None
+        # Фиксации закрытых проездов, iter_pictures отдает их вместо каждого распознавания
+        self.passage_fixations = deque()
+        self.image_writer = None
+        self.image_storage = None
+        self.watchlist = None
+        # FrameRing: кадры manual_cup для других процессов
+        self.frame_ring = None
+        self.metrics_hooks = []
+        # Ответы камеры в debug: обрезка, выборка и лимит в секунду на камеру
+        self.payload_log = PayloadLog(host)
+        self.timeouts = {endpoint: (self.timeout, read) for endpoint, read in DEFAULT_READ_TIMEOUTS.items()}
+        self.retries = 2
+        self.retry_backoff = 0.2
+        self.breaker = CircuitBreaker(name=host)
 
         self.download_path = None
         self.download_only_with_number = False
-        self.download_fixation = List[Fixation]
-        self.thread_download = Thread(target=self.__background_download__)
+        self.download_fixation = None
+        self.download_threads = []
+        self.download_retries = 3
+        self.download_retry_delay = 0.5
+
+    @property
+    def req(self) -> requests.Session:
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._check_session()
+        return self._session
 
     def _check_session(self):
-        """Check the connection with device
+        """Create the pooled session, no request is made here.
+         Auth scheme is taken from auth_cache, otherwise Basic until the camera asks for Digest
          :return request.session() object
         """
-        full_url = urljoin(self.host, self.isapi_prefix + '/System/deviceInfo')
         session = requests.session()
-        session.auth = HTTPBasicAuth(self.login, self.password)
-        response = session.get(full_url)
-        if response.status_code != 401:
-            return session
-        session.auth = HTTPDigestAuth(self.login, self.password)
-        response = session.get(full_url)
-        if response.status_code != 401:
-            return session
-        # response.raise_for_status()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        scheme = self.auth_cache.get(self.host)
+        self._auth_negotiated = scheme is not None
+        session.auth = self.__auth__(scheme or AUTH_BASIC)
         return session
 
+    def __auth__(self, scheme):
+        if scheme == AUTH_DIGEST:
+            return HTTPDigestAuth(self.login, self.password)
+        return HTTPBasicAuth(self.login, self.password)
+
+    def __negotiate__(self, response: requests.Response) -> bool:
+        """Pick the scheme from WWW-Authenticate of a 401 answer.
+         :return True if the request should be sent again with the new scheme
+        """
+        challenge = response.headers.get("WWW-Authenticate", "").lower()
+        scheme = AUTH_DIGEST if "digest" in challenge else AUTH_BASIC
+        # Решаем по схеме этого запроса: параллельный запрос мог уже сменить self.req.auth
+        if _auth_scheme(response.request) == scheme:
+            return False
+        with self._auth_lock:
+            if self._auth_negotiated:
+                # Схема из кэша устарела
+                self.auth_cache.forget(self.host)
+                self._auth_negotiated = False
+            if not isinstance(self.req.auth, HTTPDigestAuth if scheme == AUTH_DIGEST else HTTPBasicAuth):
+                logging.debug(f"Auth scheme for {self.host}: {scheme}")
+                self.req.auth = self.__auth__(scheme)
+        return True
+
+    def add_metrics_hook(self, hook: MetricsHook):
+        self.metrics_hooks.append(hook)
+
+    def __request__(self, endpoint, method, full_url, **kwargs) -> requests.Response:
+        """Every ISAPI call goes through here: circuit breaker, per endpoint (connect, read) timeout,
+         retries with jittered backoff for idempotent endpoints and metrics hooks.
+         Hooks get one measurement per call, latency covers all attempts; a call that ends
+         with an exception is reported with STATUS_TIMEOUT, STATUS_ERROR or STATUS_CIRCUIT_OPEN
+        """
+        time_start = time.perf_counter()
+        try:
+            response = self.__send__(endpoint, method, full_url, **kwargs)
+        except CircuitOpenError:
+            self.__on_request__(endpoint, STATUS_CIRCUIT_OPEN, time_start)
+            raise
+        except requests.Timeout:
+            self.__on_request__(endpoint, STATUS_TIMEOUT, time_start)
+            raise
+        except requests.RequestException:
+            self.__on_request__(endpoint, STATUS_ERROR, time_start)
+            raise
+        if self.metrics_hooks:
+            if kwargs.get("stream"):
+                size = int(response.headers.get("Content-Length") or 0)
+            else:
+                size = len(response.content)
+            self.__on_request__(endpoint, response.status_code, time_start, size)
+        return response
+
+    def __send__(self, endpoint, method, full_url, **kwargs) -> requests.Response:
+        self.breaker.check()
+        kwargs.setdefault("timeout", self.timeouts.get(endpoint, (self.timeout, self.timeout)))
+        attempts = self.retries + 1 if endpoint in IDEMPOTENT_ENDPOINTS else 1
+        for attempt in range(attempts):
+            try:
+                response = self.req.request(method, full_url, **kwargs)
+                if response.status_code == 401 and self.__negotiate__(response):
+                    response.close()
+                    response = self.req.request(method, full_url, **kwargs)
+                if response.status_code != 401 and not self._auth_negotiated:
+                    scheme = _auth_scheme(response.request)
+                    if scheme is not None:
+                        self._auth_negotiated = True
+                        self.auth_cache.set(self.host, scheme)
+            except requests.RequestException as e:
+                # Любая ошибка запроса - отказ, иначе пробный запрос оставит breaker в half_open
+                self.breaker.failure()
+                if attempt + 1 >= attempts or not self.breaker.allow():
+                    raise
+                error = e
+            else:
+                if response.status_code < 500:
+                    self.breaker.success()
+                    break
+                self.breaker.failure()
+                if attempt + 1 >= attempts or not self.breaker.allow():
+                    break
+                response.close()
+                error = response.status_code
+            delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+            logging.debug("Request %s failed: %s, retry %s in %.2fs", endpoint, error, attempt + 1, delay)
+            time.sleep(delay)
+        return response
+
+    def __on_request__(self, endpoint, status_code, time_start, size=0):
+        if not self.metrics_hooks:
+            return
+        latency = time.perf_counter() - time_start
+        for hook in self.metrics_hooks:
+            hook.on_request(self.host, endpoint, status_code, latency, size)
+
+    def __on_recognition__(self, recognized):
+        for hook in self.metrics_hooks:
+            hook.on_recognition(self.host, recognized)
+
+    def __on_disk_write__(self, latency, size):
+        for hook in self.metrics_hooks:
+            hook.on_disk_write(self.host, latency, size)
+
+    def enable_image_storage(self, root, max_age_days=None, max_bytes=None, **kwargs) -> ImageStorage:
+        """Save images to root/<camera>/<date>/<hour> with retention instead of the flat download dirs"""
+        self.image_storage = ImageStorage(root, max_age_days=max_age_days, max_bytes=max_bytes, **kwargs)
+        return self.image_storage
+
+    def __image_path__(self, download_path, name, date_time=None) -> str:
+        if self.image_storage is not None:
+            return self.image_storage.path_for(self.host, name, date_time)
+        return os.path.join(download_path, name)
+
+    def __on_image_written__(self, path, latency, size, date_time=None):
+        self.__on_disk_write__(latency, size)
+        if self.image_storage is not None:
+            self.image_storage.register(path, size, camera=self.host, date_time=date_time)
+
     def get_status(self) -> DeviceInfo:
         full_url = urljoin(self.host, self.isapi_prefix + '/System/deviceInfo')
-        response = self.req.get(url=full_url)
+        response = self.__request__(ENDPOINT_DEVICE_INFO, "GET", full_url)
         return DeviceInfo.from_xml_str(response.text)
 
-    def __get_pictures__(self, time_start, count=10) -> CMSearchResult:
+    def __get_pictures__(self, time_start, count=10, time_end=None, position=0, search_id=None) -> CMSearchResult:
         date_time_start = time_start.strftime("%Y-%m-%dT%H:%M:%SZ")
-        date_time_end = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-        self.last_time = datetime.datetime.now()
-        request_id = uuid.uuid4()
-        logging.debug(f"Trying get pictures: {request_id} start: {date_time_start} end: {date_time_end}")
+        if time_end is None:
+            time_end = datetime.datetime.now()
+        date_time_end = time_end.strftime("%Y-%m-%dT%H:%M:%SZ")
+        request_id = search_id if search_id is not None else uuid.uuid4()
+        logging.debug("Trying get pictures: %s start: %s end: %s position: %s", request_id, date_time_start,
+                      date_time_end, position)
         data = f"""
                 <?xml version="1.0" encoding="utf-8"?>
                 <CMSearchDescription><searchID>{request_id}</searchID>
@@ -77,96 +370,305 @@ class HikvisionClient:
                 <endTime>{date_time_end}</endTime>
                 <laneNumber></laneNumber><carType>all</carType><illegalType>all</illegalType></timeSpan>
                 </timeSpanList><contentTypeList><contentType>metadata</contentType>
-                </contentTypeList><maxResults>{count}</maxResults><searchResultPostion>0</searchResultPostion>
+                </contentTypeList><maxResults>{count}</maxResults><searchResultPostion>{position}</searchResultPostion>
                 <metadataList><metadataDescriptor>//recordType.meta.hikvision.com/timing</metadataDescriptor>
                 <SearchProperity><plateSearchMask></plateSearchMask></SearchProperity></metadataList></CMSearchDescription>
                         """
 
         full_url = urljoin(self.host, self.isapi_prefix + '/ContentMgmt/search')
-        response = self.req.post(url=full_url, data=data)
-        logging.debug(f"Result: {response.status_code} with: {response.text}")
+        response = self.__request__(ENDPOINT_SEARCH, "POST", full_url, data=data)
+        self.payload_log.debug("%s result: %s with: %s", response.status_code, lambda: response.text)
+        # Ответ с ошибкой - ResponseStatus, а не результат поиска
+        response.raise_for_status()
 
         return CMSearchResult.from_xml_str(response.text)
 
-    def get_pictures(self):
+    def search(self, time_start, time_end=None, page_size=20) -> Iterator[SearchMatchItem]:
+        """Yields all matches of the window, following responseStatusStrg MORE page by page.
+         The same searchID is kept for every page of one window.
+        """
+        if time_end is None:
+            time_end = datetime.datetime.now()
+        search_id = uuid.uuid4()
+        position = 0
+        while True:
+            cms_result = self.__get_pictures__(time_start=time_start, count=page_size, time_end=time_end,
+                                               position=position, search_id=search_id)
+            logging.debug("Id: %s, count: %s, status: %s", cms_result.search_id, cms_result.count,
+                          cms_result.status_string)
+            page = cms_result.search_list
+            for result in page:
+                yield result
+            position += len(page)
+            if not page or not cms_result.has_more():
+                return
+
+    def get_pictures(self) -> List[Fixation]:
+        return list(self.iter_pictures())
+
+    def iter_pictures(self) -> Iterator[Fixation]:
+        """New fixations of the current window in event time order.
+         pictureInformation requests run concurrently (metadata_concurrency in flight),
+         each fixation is yielded as soon as it and all earlier ones are ready.
+         With coalescing on, recognized plates are yielded once per passage, when the passage closes
+         (possibly on a later call)
+        """
         time_start = self.get_date_time_start()
-        cms_result = self.__get_pictures__(time_start=time_start, count=20)
-        logging.debug(f"Id: {cms_result.search_id}, count: {cms_result.count}")
-        for result in cms_result.search_list:
+        time_end = datetime.datetime.now()
+        new_results = []
+        for result in self.search(time_start=time_start, time_end=time_end, page_size=self.search_page_size):
             if result.play_back_uri not in self.known_play_uri:
-                logging.debug(
-                    f"Id: {result.track_id}, time: {result.time_start}, playback: {result.play_back_uri}, description: {result.description}")
+                logging.debug("Id: %s, time: %s, playback: %s", result.track_id, result.time_start,
+                              result.play_back_uri)
+                new_results.append(result)
+        new_results.sort(key=lambda r: r.time_start)
+
+        pending = deque()
+        results = iter(new_results)
+        for result in itertools.islice(results, self.metadata_concurrency):
+            pending.append((result, self.__metadata_executor__().submit(self.__get_meta_data__, result.play_back_uri)))
+        while pending:
+            result, future = pending.popleft()
+            meta = future.result()
+            for next_result in itertools.islice(results, 1):
+                pending.append((next_result,
+                                self.__metadata_executor__().submit(self.__get_meta_data__, next_result.play_back_uri)))
+            logging.info("New fixation number: %s, time: %s, type: %s: color: %s", meta.number, result.time_start,
+                         meta.type, meta.color)
+            # Водяной знак по времени камеры и только за обработанными: при ошибке остальные найдутся снова
+            result_time = result.time_start_datetime
+            self.known_play_uri.add(result.play_back_uri, event_time=result_time.timestamp())
+            self.__move_watermark__(result_time)
+            fixation = Fixation(url=result.play_back_uri, number=meta.number, date_time=result.time_start,
+                                color=meta.color, car_type=meta.type)
+            if self.coalescer is not None and fixation.number != "unknown":
+                # Сохранение и загрузка - один раз на проезд, в __on_passage__
+                self.coalescer.offer(self.host, fixation.number, result.time_start_datetime, payload=fixation)
+            else:
+                self.__dispatch_fixation__(fixation)
+                yield fixation
+            yield from self.__closed_passages__()
+        # Окно пройдено целиком: тихий период не растит следующее окно
+        self.__move_watermark__(time_end - datetime.timedelta(seconds=self.watermark_margin))
+        self.__save_watermark__()
+        yield from self.__closed_passages__()
 
-                meta = self.__get_meta_data__(result.play_back_uri)
-                logging.info(
-                    f"New fixation number: {meta.number}, time: {result.time_start}, type: {meta.type}: color: {meta.color}")
-                self.known_play_uri.append(result.play_back_uri)
-                fixation = Fixation(url=result.play_back_uri, number=meta.number, date_time=result.time_start)
-                # self.download_fixation.append(fixation)
+    def __closed_passages__(self) -> Iterator[Fixation]:
+        while self.passage_fixations:
+            yield self.passage_fixations.popleft()
+
+    def __dispatch_fixation__(self, fixation: Fixation, passage: Passage = None):
+        image_path = None
+        if self.download_fixation is not None and \
+                not (fixation.number == "unknown" and self.download_only_with_number):
+            image_path = self.__download_file__(fixation)
+        if self.fixation_store is not None:
+            hits, dwell = (passage.hits, passage.dwell.total_seconds()) if passage is not None else (None, None)
+            self.fixation_store.add_fixation(self.host, fixation, image_path=image_path, hits=hits, dwell=dwell)
+        self.__check_watchlist__(fixation.number, self.__fixation_time__(fixation), image_path)
+        if self.download_fixation is not None:
+            # Блокируется при полной очереди - опрос ждет загрузку
+            self.download_fixation.put(fixation)
+
+    def enable_coalescing(self, window=5.0, policy=POLICY_BEST):
+        """Repeated recognitions of one plate within window seconds give one saved frame and one fixation"""
+        self.coalescer = PlateCoalescer(self.__on_passage__, window=window, policy=policy)
+
+    def __on_passage__(self, passage: Passage):
+        logging.info(f"Passage: {passage.plate}, hits: {passage.hits}, dwell: {passage.dwell}")
+        if isinstance(passage.payload, Fixation):
+            self.__dispatch_fixation__(passage.payload, passage)
+            self.passage_fixations.append(passage.payload)
+            return
+        image_path = None
+        if passage.image is not None:
+            download_path, filename = passage.payload
+            image_path = self.__save_image_from_bytes__(download_path=download_path, name=filename, raw=passage.image,
+                                                        date_time=passage.first_time)
+        self.__record_fixation__(passage.plate, image_path, date_time=passage.first_time, passage=passage)
+
+    def __metadata_executor__(self) -> ThreadPoolExecutor:
+        if self.metadata_executor is None:
+            self.metadata_executor = ThreadPoolExecutor(max_workers=self.metadata_concurrency,
+                                                        thread_name_prefix="metadata")
+        return self.metadata_executor
+
+    def close(self):
+        """Close the open passages, stop the metadata workers, save the seen index and close the pooled session"""
+        if self.coalescer is not None:
+            self.coalescer.close()
+            self.coalescer = None
+        if self.metadata_executor is not None:
+            self.metadata_executor.shutdown(wait=True)
+            self.metadata_executor = None
+        self.known_play_uri.flush()
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
     def __get_meta_data__(self, play_back_uri) -> PictureInformation:
         request_id = uuid.uuid4()
-        logging.debug(f"Trying get pictures: {request_id}")
+        logging.debug("Trying get pictures: %s", request_id)
         data = f"""
                 <?xml version="1.0"?><downloadRequest version="1.0" xmlns="http://urn:selfextension:psiaext-ver10-xsd"><playbackURI>
                 {play_back_uri}
                 </playbackURI></downloadRequest>   """
         data = data.replace("&", "&amp;")
         full_url = urljoin(self.host, self.isapi_prefix + '/ITC/ContentMgmt/pictureInformation')
-        response = self.req.post(url=full_url, data=data)
-        logging.debug(f"Result: {response.status_code} with: {response.text}")
+        response = self.__request__(ENDPOINT_PICTURE_INFORMATION, "POST", full_url, data=data)
+        self.payload_log.debug("%s result: %s with: %s", response.status_code, lambda: response.text)
+        response.raise_for_status()
 
         return PictureInformation.from_xml_str(response.text)
 
+    def advance_watermark(self, date_time: datetime.datetime):
+        """Move last_time forward (never back), e.g. after a backfill of the range before it"""
+        if self.__move_watermark__(date_time):
+            self.__save_watermark__()
+
+    def __move_watermark__(self, date_time: datetime.datetime) -> bool:
+        if self.last_time is not None and date_time <= self.last_time:
+            return False
+        self.last_time = date_time
+        # Совпадения с водяного знака поиск вернет снова, их uri не вытесняются из known_play_uri
+        self.known_play_uri.keep_after = date_time.timestamp()
+        return True
+
+    def __load_watermark__(self):
+        if self.watermark_path is None or not os.path.exists(self.watermark_path):
+            return
+        try:
+            with open(self.watermark_path, 'r') as f:
+                self.__move_watermark__(datetime.datetime.strptime(f.read().strip(), "%Y-%m-%dT%H:%M:%S"))
+        except (OSError, ValueError):
+            logging.error(f"Can't load watermark: {self.watermark_path}")
+
+    def __save_watermark__(self):
+        # Водяной знак включительный: все обработанные до него uri должны быть на диске раньше него
+        self.known_play_uri.flush()
+        if self.watermark_path is None or self.last_time is None:
+            return
+        tmp_path = self.watermark_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.last_time.strftime("%Y-%m-%dT%H:%M:%S"))
+        os.replace(tmp_path, self.watermark_path)
+
     def get_date_time_start(self) -> datetime.datetime:
+        """Start of the next search window: the watermark (inclusive, duplicates are filtered by
+         known_play_uri, which keeps every uri at or after it) or the last 10 minutes on the first run
+        """
         if self.last_time is None:
-            self.last_time = datetime.datetime.now() - datetime.timedelta(minutes=10)
+            return datetime.datetime.now() - datetime.timedelta(minutes=10)
 
-        return self.last_time - datetime.timedelta(seconds=10)
+        return self.last_time
 
-    def background_download_pictures(self, path, only_with_number=False):
+    def background_download_pictures(self, path, only_with_number=False, workers=2, queue_size=100):
         download_path = os.path.join(path, "pictures")
         if not os.path.exists(download_path):
             os.mkdir(download_path)
         self.download_path = download_path
         self.download_only_with_number = only_with_number
-        # self.thread_download.start()
+        self.download_fixation = queue.Queue(maxsize=queue_size)
+        self.download_threads = [Thread(target=self.__background_download__, name=f"download-{i}", daemon=True)
+                                 for i in range(workers)]
+        for thread in self.download_threads:
+            thread.start()
+
+    def stop_background_download(self):
+        """Finish queued downloads and stop the workers"""
+        for _ in self.download_threads:
+            self.download_fixation.put(None)
+        for thread in self.download_threads:
+            thread.join()
+        self.download_threads = []
+        self.download_fixation = None
 
     def __background_download__(self):
         logging.info(f"Download dir: {self.download_path}")
         while True:
-            if len(self.download_fixation) > 0:
-                fixation = self.download_fixation.pop(0)
-                if fixation.number == "unknown" and self.download_only_with_number:
-                    continue
-                # Тут загрузка элемента
-                logging.debug(f"Download: {fixation.date_time}, number: {fixation.number} with: {fixation.url}")
-                name = f"{fixation.date_time.replcae('.', '_')}_{fixation.number}.jpg"
-                self.__image_download__(self.download_path, fixation.url, name)
-            time.sleep(0.1)
-
-    def __image_download__(self, download_path, url, name):
-        logging.debug(f"Download pictures: {url}")
+            fixation = self.download_fixation.get()
+            if fixation is None:
+                return
+            if fixation.number == "unknown" and self.download_only_with_number:
+                continue
+            # Тут загрузка элемента
+            logging.debug("Download: %s, number: %s with: %s", fixation.date_time, fixation.number, fixation.url)
+            name = self.__download_name__(fixation)
+            for attempt in range(1, self.download_retries + 1):
+                try:
+                    self.__image_download__(self.download_path, fixation.url, name,
+                                            date_time=self.__fixation_time__(fixation))
+                    break
+                except CircuitOpenError as e:
+                    # Камера недоступна, повторы только продлят отказ
+                    logging.error(f"Download skipped: {name}, {e}")
+                    break
+                except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+                    if attempt == self.download_retries:
+                        logging.error(f"Download failed: {name}, {e}")
+                        break
+                    delay = self.download_retry_delay * 2 ** (attempt - 1)
+                    logging.debug(f"Download error: {name}, {e}, retry {attempt} in {delay}s")
+                    time.sleep(delay)
+                except Exception:
+                    # Поток загрузки не должен умирать, иначе опрос встанет на полной очереди
+                    logging.error(f"Download failed: {name}")
+                    logging.debug(traceback.format_exc())
+                    break
+
+    @staticmethod
+    def __download_name__(fixation: Fixation) -> str:
+        return f"{fixation.date_time.replace(':', '_').replace('.', '_')}_{_safe_name(fixation.number)}.jpg"
+
+    @staticmethod
+    def __fixation_time__(fixation: Fixation):
+        # Шард по времени камеры, если оно разбирается
+        try:
+            return datetime.datetime.strptime(fixation.date_time, "%Y-%m-%dT%H:%M:%SZ")
+        except (TypeError, ValueError):
+            return None
+
+    def __download_file__(self, fixation: Fixation) -> str:
+        return self.__image_path__(self.download_path, self.__download_name__(fixation),
+                                   self.__fixation_time__(fixation))
+
+    def __image_download__(self, download_path, url, name, date_time=None):
+        logging.debug("Download pictures: %s", url)
         data = f"""
                        <?xml version="1.0"?><downloadRequest version="1.0" xmlns="http://urn:selfextension:psiaext-ver10-xsd"><playbackURI>
                        {url}
                        </playbackURI></downloadRequest>   """
         data = data.replace("&", "&amp;")
         full_url = urljoin(self.host, self.isapi_prefix + '/ITC/ContentMgmt/download')
-        response = self.req.get(url=full_url, data=data, stream=True)
+        with self.__request__(ENDPOINT_DOWNLOAD, "GET", full_url, data=data, stream=True) as response:
+            if response.status_code >= 500:
+                response.raise_for_status()
+            if response.status_code != 200:
+                logging.error(f"Download error: {response.status_code} {name}")
+                return
 
-        if response.status_code == 200:
-            with open(os.path.join(download_path, name), 'wb') as f:
-                response.raw.decode_content = True
-                shutil.copyfileobj(response.raw, f)
+            # Пишем во временный файл и переименовываем, чтобы не оставлять обрезанных jpg
+            file_name = self.__image_path__(download_path, name, date_time)
+            tmp_name = file_name + ".part"
+            try:
+                with open(tmp_name, 'wb') as f:
+                    response.raw.decode_content = True
+                    written, write_time = _copy_stream(response.raw, f)
+                os.replace(tmp_name, file_name)
+                self.__on_image_written__(file_name, write_time, written, date_time)
+            except BaseException:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                raise
 
-        logging.debug(f"Download finish: {os.path.join(download_path, name)}")
+        logging.debug("Download finish: %s", file_name)
 
     def manual_cup(self, path, unrecognized_photo_save=False):
-        logging.debug(f"Trying manual cup")
+        logging.debug("Trying manual cup")
         time_start = datetime.datetime.utcnow()
         full_url = urljoin(self.host, self.isapi_prefix + '/ITC/manualCap')
-        response = self.req.put(url=full_url)
+        response = self.__request__(ENDPOINT_MANUAL_CAP, "PUT", full_url)
         path = os.path.join(path, "manual_pictures")
         if not os.path.exists(path):
             os.mkdir(path)
@@ -176,65 +678,198 @@ class HikvisionClient:
             number, recognize = self.parse_message_from_byte(response.content,
                                                              unrecognized_photo_save=unrecognized_photo_save,
                                                              download_path=path)
+            self.__on_recognition__(recognize)
             if recognize:
-                logging.info(f"Detected, time {datetime.datetime.utcnow() - time_start}: Number: {number}")
+                logging.info("Detected, time %s: Number: %s", datetime.datetime.utcnow() - time_start, number)
             else:
-                logging.debug(f"Manual Cup, time {datetime.datetime.utcnow() - time_start}: Response: {number}")
+                logging.debug("Manual Cup, time %s: Response: %s", datetime.datetime.utcnow() - time_start, number)
+            return number, recognize
+        return None, False
+
+    def manual_cup_stream(self, path, unrecognized_photo_save=False):
+        """Same as manual_cup, but never holds the whole frame in memory.
+         Reads the fixed header first, then the JPEG goes straight to disk or is drained
+         through one reused buffer.
+        """
+        logging.debug("Trying manual cup (stream)")
+        time_start = datetime.datetime.utcnow()
+        full_url = urljoin(self.host, self.isapi_prefix + '/ITC/manualCap')
+        path = os.path.join(path, "manual_pictures")
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        with self.__request__(ENDPOINT_MANUAL_CAP, "PUT", full_url, stream=True) as response:
+            if response.status_code != 200:
+                return None, False
+            response.raw.decode_content = True
+            number, recognize = self.parse_message_from_stream(response.raw,
+                                                               unrecognized_photo_save=unrecognized_photo_save,
+                                                               download_path=path)
+        self.__on_recognition__(recognize)
+        if recognize:
+            logging.info("Detected, time %s: Number: %s", datetime.datetime.utcnow() - time_start, number)
+        else:
+            logging.debug("Manual Cup, time %s: Response: %s", datetime.datetime.utcnow() - time_start, number)
+        return number, recognize
+
+    def parse_message_from_stream(self, raw, unrecognized_photo_save=False, download_path=''):
+        """
+         Потоковый вариант parse_message_from_byte: заголовок до первого SOI разбирается как в decode_frame,
+         без SOI в первых 764 байтах посылка - статус или кадр без jpeg, ее читаем целиком.
+         Кадр - самая большая картинка посылки, на диск пишется по кускам; в памяти только для
+         FrameRing и склейки проездов
+        :param raw: file-like object with readinto (response.raw)
+        :param unrecognized_photo_save:
+        :param download_path:
+        :return:
+        """
+        header = bytearray(MANUAL_CAP_IMAGE_OFFSET + len(JPEG_SOI))
+        size = _read_into(raw, memoryview(header))
+        image_start = header.find(JPEG_SOI, 0, size)
+        if image_start < 0:
+            return self.parse_message_from_byte(bytes(header[:size]) + raw.read(),
+                                                unrecognized_photo_save=unrecognized_photo_save,
+                                                download_path=download_path)
+        frame = decode_header(header, image_start)
+        if self.frame_ring is not None or (frame.recognized and self.coalescer is not None):
+            frame.images = tuple(_read_jpegs(raw, header, image_start, size))
+            return self.__handle_frame__(frame, unrecognized_photo_save, download_path)
 
-    def __save_image__(self, download_path, name, raw):
-        with open(os.path.join(download_path, name), 'wb') as f:
-            shutil.copyfileobj(raw, f)
-        logging.info(f"Saved photo: {name} size: {human_size(len(raw))} - {download_path}")
+        response = frame.plate or UNKNOWN_PLATE
+        recognize = frame.recognized
+        image_path = None
+        if unrecognized_photo_save or recognize:
+            date = datetime.datetime.now()
+            filename = f"{_safe_name(response)}_{date.strftime('%Y_%d_%m-%H_%M_%S')}.jpg"
+            image_path = self.__stream_scene__(raw, header, image_start, size,
+                                               self.__image_path__(download_path, filename, date), date)
+            if image_path is not None:
+                logging.info("Saved photo: %s - %s", filename, download_path)
+        else:
+            _drain(raw)
+        if recognize:
+            self.__record_fixation__(response, image_path)
+        return response, recognize
 
-    def __save_image_from_bytes__(self, download_path, name, raw):
-        with open(os.path.join(download_path, name), 'wb') as f:
+    def __stream_scene__(self, raw, header, image_start, size, file_name, date_time):
+        """Write every image of the stream to its own .part file, keep the largest as file_name"""
+        parts = []
+        write_time = 0.0
+        try:
+            f = None
+            try:
+                for new, piece in _jpeg_pieces(raw, header, image_start, size):
+                    if new:
+                        if f is not None:
+                            f.close()
+                        parts.append([f"{file_name}.{len(parts)}.part", 0])
+                        f = open(parts[-1][0], 'wb')
+                    time_start = time.perf_counter()
+                    f.write(piece)
+                    write_time += time.perf_counter() - time_start
+                    parts[-1][1] += len(piece)
+            finally:
+                if f is not None:
+                    f.close()
+        except BaseException:
+            for path, _ in parts:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        # Кадр - самая большая картинка, как в decode_frame, вырезку номера удаляем
+        scene = max(parts, key=lambda part: part[1]) if parts else None
+        for part in parts:
+            if part is not scene:
+                os.remove(part[0])
+        if scene is None or not scene[1]:
+            if scene is not None:
+                os.remove(scene[0])
+            self.__on_disk_write__(write_time, 0)
+            return None
+        os.replace(scene[0], file_name)
+        self.__on_image_written__(file_name, write_time, scene[1], date_time)
+        return file_name
+
+    def __record_fixation__(self, number, image_path=None, date_time=None, passage: Passage = None):
+        """Journal a manual capture in fixation_store and check the watchlist, if they are set"""
+        date_time = date_time or datetime.datetime.now()
+        if self.fixation_store is not None:
+            hits, dwell = (passage.hits, passage.dwell.total_seconds()) if passage is not None else (None, None)
+            self.fixation_store.add(self.host, date_time, number, image_path=image_path, hits=hits, dwell=dwell)
+        self.__check_watchlist__(number, date_time, image_path)
+
+    def __check_watchlist__(self, number, date_time=None, image_path=None):
+        if self.watchlist is not None:
+            self.watchlist.check(number, camera=self.host, date_time=date_time, image_path=image_path)
+
+    def __save_image__(self, download_path, name, raw, date_time=None) -> str:
+        """Save a file-like object (e.g. response.raw)"""
+        file_name = self.__image_path__(download_path, name, date_time)
+        with open(file_name, 'wb') as f:
+            written, write_time = _copy_stream(raw, f)
+        self.__on_image_written__(file_name, write_time, written, date_time)
+        logging.info("Saved photo: %s size: %s - %s", name, human_size(written), download_path)
+        return file_name
+
+    def __save_image_from_bytes__(self, download_path, name, raw, date_time=None) -> Optional[str]:
+        """Save raw bytes, returns the path the image is (or will be) written to,
+         None if the image writer queue is full and the image is dropped
+        """
+        file_name = self.__image_path__(download_path, name, date_time)
+        if self.image_writer is not None:
+            # Запись в фоне, захват не ждет диск
+            if not self.image_writer.write(file_name, raw, callback=lambda latency, size: self.__on_image_written__(
+                    file_name, latency, size, date_time)):
+                return None
+            logging.info("Queued photo: %s size: %s - %s", name, human_size(len(raw)), download_path)
+            return file_name
+        time_start = time.perf_counter()
+        with open(file_name, 'wb') as f:
             f.write(raw)
             f.close()
-        logging.info(f"Saved photo: {name} size: {human_size(len(raw))} - {download_path}")
+        self.__on_image_written__(file_name, time.perf_counter() - time_start, len(raw), date_time)
+        logging.info("Saved photo: %s size: %s - %s", name, human_size(len(raw)), download_path)
+        return file_name
 
     def parse_message_from_byte(self, content, unrecognized_photo_save=False, download_path=''):
         """
-         1 - Пробуем разобрать xml в посылке на 272 байт
-         2- При ошибке ищем слово unknown
-         3 - Альтернативные посылки пока сохраняем
+         Разбор посылки manualCap через decode_frame:
+         статус ResponseStatus, номер из заголовка, кадр - самый большой jpeg посылки
         :param download_path:
         :param content:
         :param unrecognized_photo_save:
-        :return:
+        :return: (number, recognize), ("Ok", False) for the OK status
         """
-        if len(content) == 272:
-            try:
-                response = content[0:272].decode().lstrip('\x00').rstrip('\x00')
-                xml_dict = xmltodict.parse(response)
-                if 'ResponseStatus' in xml_dict and "statusString" in xml_dict["ResponseStatus"] and \
-                        xml_dict["ResponseStatus"]['statusString'] == "OK":
-                    return "Ok", False
-                else:
-                    logging.info(f'Error parse: {response}')
-            except UnicodeDecodeError:
-                logging.debug("Parse error")
-
-        if len(content) > 300:
-            try:
-                recognize = False
-                response = content[88:100].decode().lstrip('\x00').rstrip('\x00')
-                if response == "unknown":
-                    recognize = False
-                else:
-                    recognize = True
-                    # logging.info(f'!!! Detected number: {response}')
-                    # logging.debug(content)
-                if unrecognized_photo_save or recognize:
-                    date = datetime.datetime.now().strftime("%Y_%d_%m-%H_%M_%S")
-                    filename = f"{response}_{date}.jpg"
-                    # s.find(b'\xff\xd8\xff')
-                    # FF D8 FF - 764
-                    # FF D9
-                    if len(content) > 764:
-                        raw = content[764:]
-                        self.__save_image_from_bytes__(download_path=download_path, name=filename, raw=raw)
-                return response, recognize
-            except UnicodeDecodeError:
-                logging.info("Parse error")
-                logging.debug(content)
-        return None, False
+        frame = decode_frame(content)
+        if frame is None:
+            logging.info("Parse error")
+            return None, False
+        if frame.status is not None:
+            if frame.status == "OK":
+                return "Ok", False
+            logging.info(f'Error parse: {frame.status}')
+            return None, False
+        return self.__handle_frame__(frame, unrecognized_photo_save, download_path)
+
+    def __handle_frame__(self, frame: ManualCapFrame, unrecognized_photo_save=False, download_path=''):
+        response = frame.plate or UNKNOWN_PLATE
+        recognize = frame.recognized
+        image = frame.scene
+        if self.frame_ring is not None and image is not None:
+            self.frame_ring.put(self.host, response, image)
+        if recognize and self.coalescer is not None:
+            date = datetime.datetime.now()
+            filename = f"{_safe_name(response)}_{date.strftime('%Y_%d_%m-%H_%M_%S')}.jpg"
+            # Уверенность камеры, если она есть, иначе размер кадра
+            score = frame.confidence if frame.confidence is not None else len(image) if image else None
+            self.coalescer.offer(self.host, response, date, image=image, payload=(download_path, filename),
+                                 score=score)
+            return response, recognize
+        image_path = None
+        if (unrecognized_photo_save or recognize) and image is not None:
+            date = datetime.datetime.now().strftime("%Y_%d_%m-%H_%M_%S")
+            filename = f"{_safe_name(response)}_{date}.jpg"
+            image_path = self.__save_image_from_bytes__(download_path=download_path, name=filename, raw=image)
+        if recognize:
+            self.__record_fixation__(response, image_path)
+        return response, recognize
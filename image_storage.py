@@ -0,0 +1,124 @@
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+import traceback
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image (
+    path TEXT PRIMARY KEY,
+    camera TEXT NOT NULL,
+    time REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_time ON image (time);
+"""
+
+
+class ImageStorage:
+    """Image tree root/<camera>/<YYYY-MM-DD>/<HH>/<name> with a SQLite index of stored files.
+    Retention by age and by total size runs in the background, oldest files first,
+    in small batches taken from the index, so the tree is never listed.
+    """
+
+    def __init__(self, root, max_age_days=None, max_bytes=None, index_path=None, cleanup_interval=60.0,
+                 batch_size=100):
+        self.root = root
+        self.max_age = datetime.timedelta(days=max_age_days) if max_age_days else None
+        self.max_bytes = max_bytes
+        self.cleanup_interval = cleanup_interval
+        self.batch_size = batch_size
+        self.deleted = 0
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(index_path or os.path.join(root, "index.db"), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM image").fetchone()[0]
+        self._known_dirs = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.__cleanup_loop__, name="image-storage", daemon=True)
+        self._thread.start()
+
+    def path_for(self, camera: str, name: str, date_time: datetime.datetime = None) -> str:
+        """Full path for a new image, the shard directory is created on first use"""
+        date_time = date_time or datetime.datetime.now()
+        directory = os.path.join(self.root, _safe_name(camera), date_time.strftime("%Y-%m-%d"),
+                                 date_time.strftime("%H"))
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+        return os.path.join(directory, name)
+
+    def register(self, path: str, size: int, camera: str = "", date_time: datetime.datetime = None):
+        date_time = date_time or datetime.datetime.now()
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM image WHERE path = ?", (path,)).fetchone()
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO image (path, camera, time, size) VALUES (?, ?, ?, ?)",
+                                 (path, camera, date_time.timestamp(), size))
+            self.total_bytes += size - (previous[0] if previous else 0)
+
+    def cleanup(self) -> int:
+        """Delete one batch of files over the age or size limit, returns how many were deleted"""
+        border = (datetime.datetime.now() - self.max_age).timestamp() if self.max_age is not None else None
+        over_quota = self.total_bytes - self.max_bytes if self.max_bytes is not None else 0
+        if border is None and over_quota <= 0:
+            return 0
+        with self._lock:
+            rows = self._db.execute("SELECT path, time, size FROM image ORDER BY time LIMIT ?",
+                                    (self.batch_size,)).fetchall()
+        removed = []
+        freed = 0
+        for path, time, size in rows:
+            # Идём от самых старых: как только файл и не просрочен, и квота соблюдена - дальше только новее
+            if (border is None or time >= border) and freed >= over_quota:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.error(f"Can't delete image: {path}")
+                continue
+            removed.append((path,))
+            freed += size
+            self.__remove_empty_dirs__(os.path.dirname(path))
+        if removed:
+            with self._lock:
+                with self._db:
+                    self._db.executemany("DELETE FROM image WHERE path = ?", removed)
+                self.total_bytes -= freed
+            self.deleted += len(removed)
+            logging.debug(f"Image storage: deleted {len(removed)} files, {freed} bytes")
+        return len(removed)
+
+    def __remove_empty_dirs__(self, directory):
+        # Удаляем опустевшие каталоги часа и дня, без обхода дерева
+        for _ in range(2):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            self._known_dirs.discard(directory)
+            directory = os.path.dirname(directory)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._db.close()
+
+    def __cleanup_loop__(self):
+        while not self._stop.wait(self.cleanup_interval):
+            try:
+                # Пачками, пока есть что удалять
+                while self.cleanup() and not self._stop.is_set():
+                    pass
+            except Exception:
+                logging.error("Image storage cleanup failed")
+                logging.debug(traceback.format_exc())
+
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^0-9A-Za-z.-]+", "_", value).strip("_") or "camera"
@@ -0,0 +1,102 @@
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Optional
+
+DURABILITY_NONE = "none"
+DURABILITY_FSYNC = "fsync"
+DURABILITY_PERIODIC = "periodic"
+
+
+class ImageWriter:
+    """Writes images on its own threads, the capture loop only puts them in a bounded queue.
+    When the queue is full the image is dropped and counted, never waited for.
+    durability: none - leave it to the OS, fsync - fsync every file,
+    periodic - os.sync() every sync_interval seconds.
+    """
+
+    def __init__(self, queue_size=64, workers=1, durability=DURABILITY_NONE, sync_interval=5.0):
+        if durability not in (DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_PERIODIC):
+            raise ValueError(f"Unknown durability: {durability}")
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._threads = [threading.Thread(target=self.__worker__, name=f"image-writer-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def write(self, path: str, data, callback: Optional[Callable[[float, int], None]] = None) -> bool:
+        """Queue data for path, callback(write seconds, size) is called after the write.
+         :return False if the queue is full and the image is dropped
+        """
+        try:
+            self._queue.put_nowait((path, data, callback))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logging.error(f"Image writer queue full, dropped: {path}")
+            return False
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self):
+        """Wait until every queued image is written"""
+        self._queue.join()
+        if self.durability == DURABILITY_PERIODIC:
+            os.sync()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put((None, None, None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.durability == DURABILITY_PERIODIC:
+            os.sync()
+
+    def __worker__(self):
+        while True:
+            path, data, callback = self._queue.get()
+            try:
+                if path is None:
+                    return
+                time_start = time.perf_counter()
+                with open(path, 'wb') as f:
+                    f.write(data)
+                    if self.durability == DURABILITY_FSYNC:
+                        f.flush()
+                        os.fsync(f.fileno())
+                latency = time.perf_counter() - time_start
+                with self._lock:
+                    self.written += 1
+                if callback is not None:
+                    callback(latency, len(data))
+                self.__periodic_sync__()
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                logging.error(f"Image write failed: {path}")
+                logging.debug(traceback.format_exc())
+            finally:
+                self._queue.task_done()
+
+    def __periodic_sync__(self):
+        if self.durability != DURABILITY_PERIODIC:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sync < self.sync_interval:
+                return
+            self._last_sync = now
+        os.sync()
@@ -1,29 +1,82 @@
+import atexit
 import logging
+import logging.handlers
 import os.path
+import queue
 
+FORMAT = "%(asctime)-15s %(levelname)s - %(message)s"
 
-def initialize_logger(output_dir):
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    # Не форматируем в потоке запроса: сообщение соберет поток QueueListener
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _file_handler(path, level, max_bytes, backup_count, when):
+    if when is not None:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, delay=True)
+    elif max_bytes:
+        handler = logging.handlers.RotatingFileHandler(path, "a", maxBytes=max_bytes, backupCount=backup_count,
+                                                       delay=True)
+    else:
+        handler = logging.FileHandler(path, "a", delay=True)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    return handler
+
+
+def initialize_logger(output_dir, use_queue=True, queue_size=10000, max_bytes=10 * 1024 * 1024, backup_count=5,
+                      when=None, debug_file=True):
+    """Console at INFO, error.log and all.log (DEBUG) in output_dir.
+    Files rotate at max_bytes or by time with when (e.g. "midnight"), backup_count files are kept.
+    With use_queue the request threads only put records in a bounded queue, a QueueListener
+    thread formats and writes them; when the queue is full the record is dropped.
+     :return the started QueueListener or None
+    """
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
-    if not os.path.isdir("log"):
-        os.mkdir("log")
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
     # create console handler and set level to info
     handler = logging.StreamHandler()
     handler.setLevel(logging.INFO)
-    formatter = logging.Formatter("%(asctime)-15s %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handlers = [handler]
 
     # create error file handler and set level to error
-    handler = logging.FileHandler(os.path.join(output_dir, "error.log"), "a", encoding=None, delay="true")
-    handler.setLevel(logging.ERROR)
-    formatter = logging.Formatter("%(asctime)-15s %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers.append(_file_handler(os.path.join(output_dir, "error.log"), logging.ERROR, max_bytes, backup_count,
+                                  when))
 
     # create debug file handler and set level to debug
-    handler = logging.FileHandler(os.path.join(output_dir, "all.log"), "a", encoding=None)
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)-15s %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
\ No newline at end of file
+    if debug_file:
+        handlers.append(_file_handler(os.path.join(output_dir, "all.log"), logging.DEBUG, max_bytes, backup_count,
+                                      when))
+    else:
+        logger.setLevel(logging.INFO)
+
+    if not use_queue:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+
+    records = queue.Queue(maxsize=queue_size)
+    logger.addHandler(_LazyQueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener: logging.handlers.QueueListener):
+    # Мог быть уже остановлен вызывающим
+    if listener._thread is not None:
+        listener.stop()
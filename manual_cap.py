@@ -0,0 +1,260 @@
+import logging
+import re
+from typing import Optional, Tuple
+
+import xmltodict
+
+# Разметка кадра manualCap известных прошивок: номер с 88 байта, jpeg с 764
+MANUAL_CAP_PLATE_START = 88
+MANUAL_CAP_PLATE_END = 100
+MANUAL_CAP_IMAGE_OFFSET = 764
+MANUAL_CAP_STATUS_SIZE = 272
+
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+_JPEG_SOS = 0xda
+# Маркеры без поля длины: TEM, RST0-7
+_JPEG_STANDALONE = frozenset((0x01, *range(0xd0, 0xd8)))
+
+_PLATE_TAGS = ("licensePlate", "plateNumber", "plate")
+_CONFIDENCE_TAGS = ("confidenceLevel", "confidence")
+_XML_TAG = re.compile(rb"<\?xml|<[A-Za-z]")
+
+UNKNOWN_PLATE = "unknown"
+
+
+class ManualCapFrame:
+    """Decoded manualCap response.
+    header and images are memoryviews into the response body, nothing is copied:
+    keep them only while needed, they hold the whole frame in memory.
+    """
+    __slots__ = ("status", "plate", "confidence", "plate_color", "header", "images")
+
+    def __init__(self, status: Optional[str] = None, plate: Optional[str] = None, confidence: Optional[int] = None,
+                 plate_color: Optional[str] = None, header: memoryview = None, images: Tuple[memoryview, ...] = ()):
+        self.status = status
+        self.plate = plate
+        self.confidence = confidence
+        self.plate_color = plate_color
+        self.header = header
+        self.images = images
+
+    @property
+    def recognized(self) -> bool:
+        return bool(self.plate) and self.plate != UNKNOWN_PLATE
+
+    @property
+    def scene(self) -> Optional[memoryview]:
+        """Full frame: the largest embedded image"""
+        return max(self.images, key=len) if self.images else None
+
+    @property
+    def plate_image(self) -> Optional[memoryview]:
+        """Plate crop: the smallest image, if the camera sent more than one"""
+        return min(self.images, key=len) if len(self.images) > 1 else None
+
+    def __repr__(self):
+        return f"ManualCapFrame(status={self.status}, plate={self.plate}, confidence={self.confidence}, " \
+               f"images={[len(image) for image in self.images]})"
+
+
+def decode_frame(content) -> Optional[ManualCapFrame]:
+    """Decode a manualCap body: every JPEG by its markers, header fields from the bytes before the first one.
+     :return None if the body is neither a status nor an image frame
+    """
+    if isinstance(content, memoryview):
+        # find есть у bytes, а не у memoryview
+        data = content.obj if content.contiguous and content.nbytes == len(content.obj) else content.tobytes()
+    else:
+        data = content
+    view = memoryview(data)
+    images = find_jpegs(data)
+    header_end = images[0][0] if images else len(data)
+    header = view[:header_end]
+    image_views = tuple(view[start:end] for start, end in images)
+
+    if not images:
+        status = _status(data)
+        if status is not None:
+            return ManualCapFrame(status=status, header=header)
+        # Кадр без jpeg, но с номером в заголовке
+        plate = plate_at(data) if len(data) > MANUAL_CAP_STATUS_SIZE else None
+        return ManualCapFrame(plate=plate, header=header) if plate else None
+
+    frame = decode_header(data, header_end)
+    frame.images = image_views
+    return frame
+
+
+def decode_header(data, end) -> ManualCapFrame:
+    """Header fields of an image frame whose first JPEG starts at end: xml plate and confidence,
+     otherwise the plate of the binary header. images are left empty
+    """
+    frame = ManualCapFrame(header=memoryview(data)[:end])
+    _header_xml(data, end, frame)
+    if frame.plate is None:
+        frame.plate = plate_at(data)
+    return frame
+
+
+def find_jpegs(data, start=0, end=None) -> list:
+    """(start, end) of every JPEG in data, found by SOI and EOI markers"""
+    end = len(data) if end is None else end
+    found = []
+    position = data.find(JPEG_SOI, start, end)
+    while position >= 0:
+        image_end = _jpeg_end(data, position, end)
+        if image_end is None:
+            break
+        found.append((position, image_end))
+        position = data.find(JPEG_SOI, image_end, end)
+    return found
+
+
+def _jpeg_end(data, start, end) -> Optional[int]:
+    # Идем по сегментам заголовка, чтобы не спутать EOI миниатюры EXIF с концом кадра,
+    # после SOS ищем EOI: в сжатых данных 0xFF всегда экранирован
+    position = start + 2
+    while position + 4 <= end and data[position] == 0xff:
+        marker = data[position + 1]
+        if marker == 0xff:
+            position += 1
+            continue
+        if marker in _JPEG_STANDALONE:
+            position += 2
+            continue
+        length = (data[position + 2] << 8) | data[position + 3]
+        if length < 2:
+            break
+        position += 2 + length
+        if marker == _JPEG_SOS:
+            break
+    eoi = data.find(JPEG_EOI, min(position, end), end)
+    if eoi < 0:
+        # Сегменты разобрать не удалось - просто ближайший EOI
+        eoi = data.find(JPEG_EOI, start + 2, end)
+    return eoi + 2 if eoi >= 0 else None
+
+
+class JpegEndScanner:
+    """End of one JPEG in a stream read chunk by chunk, found the same way as find_jpegs.
+    Feed it from the SOI on; feed() returns the position right after EOI once it is seen.
+    """
+
+    def __init__(self):
+        # Первые два байта - SOI
+        self._skip = 2
+        self._marker = bytearray()
+        self._sos = False
+        self._scan = False
+        self._prev_ff = False
+
+    def feed(self, data, start=0, end=None) -> int:
+        """Position in data right after the EOI, -1 if the image goes on past end"""
+        end = len(data) if end is None else end
+        position = start
+        while position < end:
+            if self._skip:
+                step = min(self._skip, end - position)
+                self._skip -= step
+                position += step
+                continue
+            if self._scan:
+                # EOI мог разрезаться между кусками
+                if self._prev_ff and data[position] == 0xd9:
+                    return position + 1
+                eoi = data.find(JPEG_EOI, position, end)
+                if eoi >= 0:
+                    return eoi + 2
+                self._prev_ff = data[end - 1] == 0xff
+                return -1
+            if self._sos:
+                self._scan = True
+                continue
+            marker = self._marker
+            marker.append(data[position])
+            position += 1
+            if marker[0] != 0xff:
+                # Сегменты разобрать не удалось - просто ближайший EOI
+                marker.clear()
+                self._scan = True
+            elif len(marker) == 2 and marker[1] == 0xff:
+                del marker[0]
+            elif len(marker) == 2 and marker[1] in _JPEG_STANDALONE:
+                marker.clear()
+            elif len(marker) == 4:
+                length = (marker[2] << 8) | marker[3]
+                self._sos = marker[1] == _JPEG_SOS
+                marker.clear()
+                if length < 2:
+                    self._scan = True
+                else:
+                    self._skip = length - 2
+        return -1
+
+
+def plate_at(data, start=MANUAL_CAP_PLATE_START, end=MANUAL_CAP_PLATE_END) -> Optional[str]:
+    """Plate of the fixed binary header field, NUL padded on both sides"""
+    end = min(len(data), end)
+    if end <= start:
+        return None
+    field = bytes(data[start:end]).lstrip(b"\x00")
+    # После номера и NUL в поле может остаться мусор
+    stop = field.find(b"\x00")
+    try:
+        plate = field[:stop if stop >= 0 else len(field)].decode().strip()
+    except UnicodeDecodeError:
+        logging.debug("Plate decode error")
+        return None
+    return plate or None
+
+
+def _status(data) -> Optional[str]:
+    match = _XML_TAG.search(data, 0, MANUAL_CAP_STATUS_SIZE * 4)
+    if match is None:
+        return None
+    try:
+        xml_dict = xmltodict.parse(bytes(data[match.start():]).rstrip(b"\x00"))
+    except Exception:
+        logging.debug("Status parse error")
+        return None
+    status = xml_dict.get("ResponseStatus")
+    return status.get("statusString") if isinstance(status, dict) else None
+
+
+def _header_xml(data, end, frame: ManualCapFrame):
+    # Некоторые прошивки кладут в заголовок xml с номером и уверенностью
+    match = _XML_TAG.search(data, 0, end)
+    if match is None:
+        return
+    xml_end = data.rfind(b">", match.start(), end)
+    if xml_end < 0:
+        return
+    try:
+        xml_dict = xmltodict.parse(bytes(data[match.start():xml_end + 1]))
+    except Exception:
+        return
+    fields = {}
+    _flatten(xml_dict, fields)
+    plate = next((fields[tag] for tag in _PLATE_TAGS if fields.get(tag)), None)
+    if plate is not None:
+        frame.plate = plate.strip()
+    confidence = next((fields[tag] for tag in _CONFIDENCE_TAGS if fields.get(tag)), None)
+    if confidence is not None:
+        try:
+            frame.confidence = int(confidence)
+        except ValueError:
+            pass
+    frame.plate_color = fields.get("plateColor")
+
+
+def _flatten(value, fields: dict):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, str):
+                fields.setdefault(key.split(":")[-1], item)
+            else:
+                _flatten(item, fields)
+    elif isinstance(value, list):
+        for item in value:
+            _flatten(item, fields)
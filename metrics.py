@@ -0,0 +1,165 @@
+import bisect
+import logging
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Union
+
+ENDPOINT_DEVICE_INFO = "deviceInfo"
+ENDPOINT_SEARCH = "search"
+ENDPOINT_PICTURE_INFORMATION = "pictureInformation"
+ENDPOINT_DOWNLOAD = "download"
+ENDPOINT_MANUAL_CAP = "manualCap"
+ENDPOINT_ALERT_STREAM = "alertStream"
+
+# status_code запросов, которые закончились без ответа камеры
+STATUS_TIMEOUT = "timeout"
+STATUS_ERROR = "error"
+STATUS_CIRCUIT_OPEN = "circuit_open"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsHook:
+    """Receiver of client measurements. Methods are called on the request thread and must be cheap.
+    status_code of on_request is the HTTP status or one of STATUS_TIMEOUT, STATUS_ERROR, STATUS_CIRCUIT_OPEN.
+    """
+
+    def on_request(self, camera: str, endpoint: str, status_code: Union[int, str], latency: float, size: int):
+        pass
+
+    def on_recognition(self, camera: str, recognized: bool):
+        pass
+
+    def on_disk_write(self, camera: str, latency: float, size: int):
+        pass
+
+
+class LoggingMetrics(MetricsHook):
+    def on_request(self, camera, endpoint, status_code, latency, size):
+        logging.debug(f"Request {camera} {endpoint}: {status_code}, {latency * 1000:.1f} ms, {size} bytes")
+
+    def on_disk_write(self, camera, latency, size):
+        logging.debug(f"Disk write {camera}: {latency * 1000:.1f} ms, {size} bytes")
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class PrometheusMetrics(MetricsHook):
+    """Keeps per-camera histograms and counters and renders them in Prometheus text format.
+    start_http_server() serves them on /metrics.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._bytes = defaultdict(int)
+        self._status = defaultdict(int)
+        self._recognition = defaultdict(int)
+        self._disk = {}
+        self._disk_bytes = defaultdict(int)
+        self._server = None
+
+    def on_request(self, camera, endpoint, status_code, latency, size):
+        key = (camera, endpoint)
+        with self._lock:
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = _Histogram(self.buckets)
+            histogram.observe(latency)
+            self._bytes[key] += size
+            self._status[(camera, endpoint, status_code)] += 1
+
+    def on_recognition(self, camera, recognized):
+        with self._lock:
+            self._recognition[(camera, "true" if recognized else "false")] += 1
+
+    def on_disk_write(self, camera, latency, size):
+        with self._lock:
+            histogram = self._disk.get(camera)
+            if histogram is None:
+                histogram = self._disk[camera] = _Histogram(self.buckets)
+            histogram.observe(latency)
+            self._disk_bytes[camera] += size
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines.append("# TYPE hikvision_request_seconds histogram")
+            for (camera, endpoint), histogram in self._latency.items():
+                lines += _render_histogram("hikvision_request_seconds", f'camera="{camera}",endpoint="{endpoint}"',
+                                           histogram)
+            lines.append("# TYPE hikvision_response_bytes_total counter")
+            for (camera, endpoint), value in self._bytes.items():
+                lines.append(f'hikvision_response_bytes_total{{camera="{camera}",endpoint="{endpoint}"}} {value}')
+            lines.append("# TYPE hikvision_responses_total counter")
+            for (camera, endpoint, code), value in self._status.items():
+                lines.append(f'hikvision_responses_total{{camera="{camera}",endpoint="{endpoint}",code="{code}"}} '
+                             f'{value}')
+            lines.append("# TYPE hikvision_captures_total counter")
+            for (camera, recognized), value in self._recognition.items():
+                lines.append(f'hikvision_captures_total{{camera="{camera}",recognized="{recognized}"}} {value}')
+            lines.append("# TYPE hikvision_disk_write_seconds histogram")
+            for camera, histogram in self._disk.items():
+                lines += _render_histogram("hikvision_disk_write_seconds", f'camera="{camera}"', histogram)
+            lines.append("# TYPE hikvision_disk_write_bytes_total counter")
+            for camera, value in self._disk_bytes.items():
+                lines.append(f'hikvision_disk_write_bytes_total{{camera="{camera}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port=9100, host="0.0.0.0"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Metrics: http://{host}:{self._server.server_address[1]}/metrics")
+        return self._server
+
+    def stop_http_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _render_histogram(name: str, labels: str, histogram: _Histogram) -> list:
+    lines = []
+    cumulative = 0
+    for bucket, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
@@ -22,28 +22,155 @@
 #    SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from datetime import datetime
-from typing import Any, Union, List
+from typing import Any, Union, List, Optional, FrozenSet, Tuple
+from xml.etree import ElementTree
 
 import xmltodict
 
+XML_DECODER_XMLTODICT = "xmltodict"
+XML_DECODER_ETREE = "etree"
+
+_xml_decoder = XML_DECODER_ETREE
+
+
+def set_xml_decoder(decoder: str):
+    """Select the default decoding backend for all entities: xmltodict or etree"""
+    global _xml_decoder
+    if decoder not in (XML_DECODER_XMLTODICT, XML_DECODER_ETREE):
+        raise ValueError(f"Unknown xml decoder: {decoder}")
+    _xml_decoder = decoder
+
+
+def get_xml_decoder() -> str:
+    return _xml_decoder
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _element_to_dict(element: ElementTree.Element, fields: Optional[FrozenSet[str]] = None, nested: dict = None):
+    """xmltodict-compatible value of the element: text for leaves, dict of children otherwise.
+    With fields set only these children are decoded, nested maps a field to the entity
+    class whose fields filter the children of that field.
+    """
+    if len(element) == 0:
+        text = element.text
+        if text is None:
+            return None
+        text = text.strip()
+        return text if text else None
+    result = {}
+    for child in element:
+        name = _local_name(child.tag)
+        if fields is not None and name not in fields:
+            continue
+        entity = nested.get(name) if nested else None
+        if entity is not None:
+            value = {}
+            for item in child:
+                item_name = _local_name(item.tag)
+                _add_value(value, item_name, _element_to_dict(item, entity.xml_fields(), entity.XML_NESTED_ENTITIES))
+            value = value if value else _element_to_dict(child)
+        else:
+            value = _element_to_dict(child)
+        _add_value(result, name, value)
+    return result
+
+
+def _add_value(result: dict, name: str, value):
+    if name not in result:
+        result[name] = value
+    elif isinstance(result[name], list):
+        result[name].append(value)
+    else:
+        result[name] = [result[name], value]
+
+
+def _to_int(value) -> Optional[int]:
+    return int(value) if value is not None else None
+
+
+def _to_datetime(value: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _field_slots(*fields: str) -> Tuple[str, ...]:
+    """Slot of every decoded field: the element name with a leading underscore"""
+    return tuple("_" + field for field in fields)
+
 
 class BaseHikvisionEntity(object):
     XML_ROOT_ELEMENT: str = None
     XML_ROOT_LIST_ELEMENT: str = None
     XML_PARSE_ATTRS = False
     TO_STRING_FIELDS = tuple()
+    # None - общий выбор через set_xml_decoder
+    XML_DECODER: str = None
+    XML_NESTED_ENTITIES = {}
+    # Преобразование значения элемента при разборе, остальные поля - строки как в xml
+    XML_FIELD_TYPES = {}
 
-    def __init__(self) -> None:
-        self._xmldict = {}
+    # Значения полей лежат в слотах наследников (_field_slots), словарь xml не хранится
+    __slots__ = ()
 
     def _from_field(self, field: str, _default: Any = None) -> Any:
-        return self._xmldict.get(field)
+        return getattr(self, "_" + field, _default)
 
     def _to_field(self, field: str, value: Any):
-        self._xmldict[field] = value
+        setattr(self, "_" + field, value)
+
+    def __decode__(self, xml_dict: dict):
+        """Fill the slots from the decoded xml, converted by XML_FIELD_TYPES once"""
+        types = self.XML_FIELD_TYPES
+        for slot in self.__slots__:
+            value = xml_dict.get(slot[1:])
+            convert = types.get(slot[1:])
+            if convert is not None and value is not None:
+                value = convert(value)
+            setattr(self, slot, value)
+
+    @classmethod
+    def xml_fields(cls) -> FrozenSet[str]:
+        """Element names declared by FIELD_* constants of the class"""
+        fields = cls.__dict__.get("_xml_fields")
+        if fields is None:
+            fields = frozenset(getattr(cls, name) for name in dir(cls)
+                               if name.startswith("FIELD_") and isinstance(getattr(cls, name), str))
+            cls._xml_fields = fields
+        return fields
 
     @classmethod
     def from_xml_str(cls, xml_str: Union[str, bytes], resolve_root_array=True):
+        decoder = cls.XML_DECODER or _xml_decoder
+        if decoder == XML_DECODER_ETREE and cls.XML_ROOT_ELEMENT and not cls.XML_PARSE_ATTRS:
+            try:
+                return cls.__from_etree__(xml_str)
+            except ElementTree.ParseError:
+                pass
+        return cls.__from_xmltodict__(xml_str)
+
+    @classmethod
+    def __from_etree__(cls, xml_str: Union[str, bytes]):
+        root = ElementTree.fromstring(xml_str)
+        name = _local_name(root.tag)
+        if cls.XML_ROOT_LIST_ELEMENT and name == cls.XML_ROOT_LIST_ELEMENT:
+            if not cls.XML_ROOT_ELEMENT:
+                return cls.from_xml_dict(_element_to_dict(root, cls.xml_fields(), cls.XML_NESTED_ENTITIES))
+            items = [cls.from_xml_dict(_element_to_dict(e, cls.xml_fields(), cls.XML_NESTED_ENTITIES))
+                     for e in root if _local_name(e.tag) == cls.XML_ROOT_ELEMENT]
+            if len(items) == 1:
+                return items[0]
+            return items if items else cls.from_xml_dict(None)
+        if cls.XML_ROOT_ELEMENT and name != cls.XML_ROOT_ELEMENT:
+            return cls.from_xml_dict(None)
+        return cls.from_xml_dict(_element_to_dict(root, cls.xml_fields(), cls.XML_NESTED_ENTITIES))
+
+    @classmethod
+    def __from_xmltodict__(cls, xml_str: Union[str, bytes]):
         parsed = xmltodict.parse(xml_str, xml_attribs=cls.XML_PARSE_ATTRS)
         if cls.XML_ROOT_LIST_ELEMENT and cls.XML_ROOT_LIST_ELEMENT in parsed:
             parsed = parsed.get(cls.XML_ROOT_LIST_ELEMENT)
@@ -57,7 +184,7 @@ class BaseHikvisionEntity(object):
     @classmethod
     def from_xml_dict(cls, xml_dict: dict):
         result = cls()
-        result._xmldict = xml_dict
+        result.__decode__(xml_dict if isinstance(xml_dict, dict) else {})
         return result
 
     def __repr__(self):
@@ -81,6 +208,9 @@ class DeviceInfo(BaseHikvisionEntity):
     FIELD_FIRMWARE_RELEASE_DATE = "firmwareReleasedDate"
     FIELD_DEVICE_TYPE = "deviceType"
 
+    __slots__ = _field_slots(FIELD_DEVICE_NAME, FIELD_DEVICE_ID, FIELD_MODEL, FIELD_SERIAL_NUMBER,
+                             FIELD_FIRMWARE_VERSION, FIELD_FIRMWARE_RELEASE_DATE, FIELD_DEVICE_TYPE)
+
     @property
     def device_name(self) -> str:
         return self._from_field(self.FIELD_DEVICE_NAME)
@@ -140,6 +270,8 @@ class InputChannel(BaseHikvisionEntity):
     FIELD_ID = "id"
     FIELD_NAME = "name"
 
+    __slots__ = _field_slots(FIELD_ID, FIELD_NAME)
+
     TO_STRING_FIELDS = (FIELD_ID, FIELD_NAME)
 
     @property
@@ -159,9 +291,49 @@ class InputChannel(BaseHikvisionEntity):
         self._to_field(self.FIELD_NAME, value)
 
 
+class ANPR(BaseHikvisionEntity):
+    XML_ROOT_ELEMENT = "ANPR"
+
+    FIELD_PLATE = "licensePlate"
+    FIELD_CONFIDENCE = "confidenceLevel"
+    FIELD_PLATE_COLOR = "plateColor"
+    FIELD_VEHICLE_TYPE = "vehicleType"
+    FIELD_DIRECTION = "direction"
+
+    __slots__ = _field_slots(FIELD_PLATE, FIELD_CONFIDENCE, FIELD_PLATE_COLOR, FIELD_VEHICLE_TYPE, FIELD_DIRECTION)
+
+    XML_FIELD_TYPES = {FIELD_CONFIDENCE: _to_int}
+
+    TO_STRING_FIELDS = (FIELD_PLATE, FIELD_CONFIDENCE)
+
+    @property
+    def plate(self) -> str:
+        return self._from_field(self.FIELD_PLATE)
+
+    @property
+    def confidence(self) -> Optional[int]:
+        return self._from_field(self.FIELD_CONFIDENCE)
+
+    @property
+    def color(self) -> str:
+        return self._from_field(self.FIELD_PLATE_COLOR)
+
+    @property
+    def vehicle_type(self) -> str:
+        return self._from_field(self.FIELD_VEHICLE_TYPE)
+
+    @property
+    def direction(self) -> str:
+        return self._from_field(self.FIELD_DIRECTION)
+
+
 class EventNotificationAlert(BaseHikvisionEntity):
     XML_ROOT_ELEMENT = "EventNotificationAlert"
 
+    EVENT_TYPE_ANPR = "ANPR"
+
+    FIELD_IP_ADDRESS = "ipAddress"
+    FIELD_ANPR = "ANPR"
     FIELD_EVENT_TYPE = "eventType"
     FIELD_EVENT_DESCRIPTION = "eventDescription"
     FIELD_CHANNEL_NAME = "channelName"
@@ -169,6 +341,14 @@ class EventNotificationAlert(BaseHikvisionEntity):
     FIELD_EVENT_STATE = "eventState"
     FIELD_EVENT_TIME = "dateTime"
 
+    __slots__ = _field_slots(FIELD_IP_ADDRESS, FIELD_ANPR, FIELD_EVENT_TYPE, FIELD_EVENT_DESCRIPTION,
+                             FIELD_CHANNEL_NAME, FIELD_CHANNEL_ID, FIELD_EVENT_STATE, FIELD_EVENT_TIME)
+
+    XML_FIELD_TYPES = {
+        FIELD_ANPR: lambda value: ANPR.from_xml_dict(value) if isinstance(value, dict) else None,
+        FIELD_EVENT_TIME: _to_datetime,
+    }
+
     @property
     def type(self) -> str:
         return self._from_field(self.FIELD_EVENT_TYPE)
@@ -210,21 +390,29 @@ class EventNotificationAlert(BaseHikvisionEntity):
         self._to_field(self.FIELD_EVENT_STATE, value)
 
     @property
-    def timestamp(self) -> datetime:
-        str_val = self._from_field(self.FIELD_EVENT_TIME)
-        if str_val is None:
-            return None
-        return datetime.fromisoformat(self._from_field(self.FIELD_EVENT_TIME))
+    def ip_address(self) -> str:
+        return self._from_field(self.FIELD_IP_ADDRESS)
+
+    @property
+    def anpr(self) -> Optional[ANPR]:
+        """Plate recognition of an ANPR event, None for other events"""
+        return self._from_field(self.FIELD_ANPR)
+
+    @property
+    def timestamp(self) -> Optional[datetime]:
+        return self._from_field(self.FIELD_EVENT_TIME)
 
     @timestamp.setter
     def timestamp(self, value: datetime):
-        self._to_field(self.FIELD_EVENT_TIME, datetime.isoformat(value))
+        self._to_field(self.FIELD_EVENT_TIME, value)
 
 
 class MediaSegmentDescriptor(BaseHikvisionEntity):
     XML_ROOT_ELEMENT = "mediaSegmentDescriptor"
     FIELD_PLAYBACK_URI = "playbackURI"
 
+    __slots__ = _field_slots(FIELD_PLAYBACK_URI)
+
     @property
     def play_back_uri(self) -> str:
         return self._from_field(self.FIELD_PLAYBACK_URI)
@@ -236,23 +424,45 @@ class SearchMatchItem(BaseHikvisionEntity):
     FIELD_TRACK_ID = "trackID"
     FIELD_DESCRIPTION = "mediaSegmentDescriptor"
     FIELD_TIME_SPAN = "timeSpan"
+    FIELD_START_TIME = "startTime"
+
+    # Из вложенных timeSpan и mediaSegmentDescriptor хранятся только нужные значения
+    __slots__ = _field_slots(FIELD_TRACK_ID, FIELD_START_TIME, MediaSegmentDescriptor.FIELD_PLAYBACK_URI) + \
+        ("_time_start_datetime",)
+
+    def __decode__(self, xml_dict: dict):
+        self._trackID = _to_int(xml_dict.get(self.FIELD_TRACK_ID))
+        description = xml_dict.get(self.FIELD_DESCRIPTION)
+        self._playbackURI = description.get(MediaSegmentDescriptor.FIELD_PLAYBACK_URI) \
+            if isinstance(description, dict) else None
+        time_span = xml_dict.get(self.FIELD_TIME_SPAN)
+        self._startTime = time_span.get(self.FIELD_START_TIME) if isinstance(time_span, dict) else None
+        try:
+            self._time_start_datetime = datetime.strptime(self._startTime, "%Y-%m-%dT%H:%M:%SZ") \
+                if self._startTime else None
+        except ValueError:
+            self._time_start_datetime = None
 
     @property
     def track_id(self) -> int:
-        return self._from_field(self.FIELD_TRACK_ID)
+        return self._trackID
 
     @property
     def description(self) -> dict:
-        return self._from_field(self.FIELD_DESCRIPTION)
+        """mediaSegmentDescriptor, only playbackURI is kept"""
+        return {MediaSegmentDescriptor.FIELD_PLAYBACK_URI: self._playbackURI}
 
     @property
     def time_start(self) -> str:
-        return self._from_field(self.FIELD_TIME_SPAN)["startTime"]
+        return self._startTime
+
+    @property
+    def time_start_datetime(self) -> datetime:
+        return self._time_start_datetime
 
     @property
     def play_back_uri(self) -> str:
-        desc = MediaSegmentDescriptor.from_xml_dict(self.description)
-        return desc.play_back_uri
+        return self._playbackURI
 
 
 class PictureInformation(BaseHikvisionEntity):
@@ -262,6 +472,8 @@ class PictureInformation(BaseHikvisionEntity):
     FIELD_COLOR = "plateColor"
     FIELD_TYPE = "carType"
 
+    __slots__ = _field_slots(FIELD_NUMBER, FIELD_COLOR, FIELD_TYPE)
+
     @property
     def number(self) -> str:
         return self._from_field(self.FIELD_NUMBER)
@@ -280,10 +492,19 @@ class CMSearchResult(BaseHikvisionEntity):
 
     FIELD_SEARCH_ID = "searchID"
     FIELD_RESPONSE_STATUS = "responseStatus"
+    FIELD_RESPONSE_STATUS_STRING = "responseStatusStrg"
     FIELD_NUMBER_OF_MATCHES = "numOfMatches"
     FIELD_MATCH_LIST = "matchList"
     FIELD_SEARCH_MATCH_LIST = "searchMatchItem"
 
+    STATUS_MORE = "MORE"
+
+    __slots__ = _field_slots(FIELD_SEARCH_ID, FIELD_RESPONSE_STATUS, FIELD_RESPONSE_STATUS_STRING,
+                             FIELD_NUMBER_OF_MATCHES, FIELD_MATCH_LIST)
+
+    XML_NESTED_ENTITIES = {FIELD_MATCH_LIST: SearchMatchItem}
+    XML_FIELD_TYPES = {FIELD_NUMBER_OF_MATCHES: _to_int}
+
     """
     <searchID>{b7fd59ec-0a8a-4bd5-b5af-9c1018652d12}</searchID>
     <responseStatus>true</responseStatus>
@@ -301,35 +522,43 @@ class CMSearchResult(BaseHikvisionEntity):
     def status(self) -> str:
         return self._from_field(self.FIELD_RESPONSE_STATUS)
 
+    @property
+    def status_string(self) -> str:
+        return self._from_field(self.FIELD_RESPONSE_STATUS_STRING)
+
     @property
     def count(self) -> int:
         return self._from_field(self.FIELD_NUMBER_OF_MATCHES)
 
+    def has_more(self) -> bool:
+        return self.status_string == self.STATUS_MORE
+
     @property
-    def search_list(self) -> List[SearchMatchItem]:
-        search_list = []
-        match_result = self._from_field(self.FIELD_MATCH_LIST)
-        if match_result is None:
-            return []
+    def search_list(self) -> Tuple[SearchMatchItem, ...]:
+        return self._matchList
+
+    def __decode__(self, xml_dict: dict):
+        super().__decode__(xml_dict)
+        self._matchList = self.__parse_search_list__(self._matchList)
+
+    def __parse_search_list__(self, match_result) -> Tuple[SearchMatchItem, ...]:
+        if not isinstance(match_result, dict) or not self.count:
+            return tuple()
 
         if self.FIELD_SEARCH_MATCH_LIST not in match_result:
-            return []
-        if int(self.count) > 1:
-            matches = match_result[self.FIELD_SEARCH_MATCH_LIST]
-            for m in matches:
-                search_list.append(SearchMatchItem.from_xml_dict(m))
-
-            return search_list
-        if int(self.count) == 1:
-            matches = match_result[self.FIELD_SEARCH_MATCH_LIST]
-            search_list.append(SearchMatchItem.from_xml_dict(matches))
-            return search_list
-        else:
-            return []
+            return tuple()
+        matches = match_result[self.FIELD_SEARCH_MATCH_LIST]
+        if not isinstance(matches, list):
+            matches = [matches]
+        return tuple(SearchMatchItem.from_xml_dict(m) for m in matches)
 
 
 class Fixation:
-    def __init__(self, url: str, number: str, date_time: str):
+    __slots__ = ("date_time", "number", "url", "color", "car_type")
+
+    def __init__(self, url: str, number: str, date_time: str, color: str = None, car_type: str = None):
         self.date_time = date_time
         self.number = number
         self.url = url
+        self.color = color
+        self.car_type = car_type
@@ -0,0 +1,66 @@
+import logging
+import random
+import threading
+import time
+
+
+class _Truncated:
+    """Formats the payload only when a handler actually writes the record"""
+    __slots__ = ("payload", "max_chars", "text")
+
+    def __init__(self, payload, max_chars):
+        self.payload = payload
+        self.max_chars = max_chars
+        self.text = None
+
+    def __str__(self):
+        # Ротация и запись форматируют запись дважды
+        if self.text is None:
+            text = self.payload() if callable(self.payload) else self.payload
+            if self.max_chars is not None and len(text) > self.max_chars:
+                text = f"{text[:self.max_chars]}... ({len(text)} chars)"
+            self.text = text
+            self.payload = None
+        return self.text
+
+
+class PayloadLog:
+    """Debug logging of camera responses for one camera.
+    Nothing is formatted unless DEBUG is enabled, only sample_rate of the payloads are logged,
+    at most rate per second (burst at once), and each one is cut to max_chars.
+    """
+
+    def __init__(self, camera, max_chars=512, sample_rate=1.0, rate=5.0, burst=20, logger: logging.Logger = None):
+        self.camera = camera
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+        self.rate = rate
+        self.burst = burst
+        self.logger = logger or logging.getLogger()
+        self.suppressed = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def debug(self, message, status, payload):
+        """message gets camera, status and the payload (a string or a callable returning it) as %s"""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if not self.__allow__():
+            return
+        self.logger.debug(message, self.camera, status, _Truncated(payload, self.max_chars))
+
+    def __allow__(self) -> bool:
+        if self.rate is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1.0:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1.0
+            return True
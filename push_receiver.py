@@ -0,0 +1,311 @@
+import datetime
+import logging
+import os
+import queue
+import re
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Tuple
+
+from alert_stream import MultipartStreamParser, _boundary
+from image_storage import ImageStorage
+from model import EventNotificationAlert
+from watchlist import Watchlist
+
+CHUNK_SIZE = 64 * 1024
+# xml события больше не бывает, защита от мусора
+MAX_XML_SIZE = 1024 * 1024
+
+
+class PushEvent:
+    """One camera upload: the alert and the images saved from it as (part name, path, size)"""
+    __slots__ = ("camera", "alert", "images")
+
+    def __init__(self, camera: str, alert: Optional[EventNotificationAlert], images: List[Tuple[str, str, int]]):
+        self.camera = camera
+        self.alert = alert
+        self.images = images
+
+    @property
+    def plate(self) -> Optional[str]:
+        anpr = self.alert.anpr if self.alert is not None else None
+        return anpr.plate if anpr is not None else None
+
+    def __repr__(self):
+        return f"PushEvent(camera={self.camera}, plate={self.plate}, images={len(self.images)})"
+
+
+class PushReceiver:
+    """HTTP server for events the cameras push themselves (HTTP listening / alarm host).
+    Every POST is read as multipart: xml parts become EventNotificationAlert, image parts are
+    written to disk chunk by chunk as they arrive. The camera gets 200 as soon as its body is
+    read, callback and fixation_store get the PushEvent from a bounded queue on worker threads.
+    """
+
+    def __init__(self, path, host="0.0.0.0", port=8080, callback: Callable[[PushEvent], None] = None,
+                 image_storage: ImageStorage = None, fixation_store=None, watchlist: Watchlist = None, queue_size=1000,
+                 workers=2):
+        self.path = path
+        self.callback = callback
+        self.image_storage = image_storage
+        self.fixation_store = fixation_store
+        self.watchlist = watchlist
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        if image_storage is None and not os.path.exists(path):
+            os.makedirs(path)
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self._threads = [threading.Thread(target=self.__worker__, name=f"push-receiver-{i}", daemon=True)
+                         for i in range(workers)]
+        self._server_thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        self._server_thread = threading.Thread(target=self.server.serve_forever, name="push-receiver", daemon=True)
+        self._server_thread.start()
+        logging.info(f"Push receiver on port {self.port}")
+        return self
+
+    def serve_forever(self):
+        for thread in self._threads:
+            thread.start()
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._server_thread is not None:
+            self._server_thread.join()
+            self._server_thread = None
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+
+    def receive(self, camera: str, content_type: str, body) -> PushEvent:
+        """Parse one upload from the body chunks, images go to disk as they arrive"""
+        if "multipart" not in content_type.lower():
+            # Часть прошивок шлет голый xml без картинок
+            data = bytearray()
+            for chunk in body:
+                data += chunk
+                if len(data) > MAX_XML_SIZE:
+                    raise ValueError("Pushed xml is too large")
+            return PushEvent(camera, self.__parse_alert__(bytes(data)), [])
+        parser = MultipartStreamParser(_boundary(content_type))
+        alert = None
+        images = []
+        part = None
+        try:
+            for chunk in body:
+                for event, value in parser.feed_stream(chunk):
+                    if event == MultipartStreamParser.EVENT_HEADERS:
+                        part = _Part(value)
+                    elif event == MultipartStreamParser.EVENT_DATA:
+                        if part.xml is None:
+                            part.xml = part.is_xml(value)
+                            if not part.xml:
+                                part.open(self.__image_path__(camera, alert, part.name))
+                        part.write(value)
+                    else:
+                        if part.file is None:
+                            alert = self.__parse_alert__(part.data()) or alert
+                        else:
+                            images.append(part.close())
+                        part = None
+        finally:
+            if part is not None and part.file is not None:
+                # Тело оборвалось на середине картинки
+                part.discard()
+        if alert is not None and camera is None:
+            camera = alert.ip_address
+        return PushEvent(camera, alert, images)
+
+    def __parse_alert__(self, data: bytes) -> Optional[EventNotificationAlert]:
+        if not data.strip():
+            return None
+        try:
+            return EventNotificationAlert.from_xml_str(data)
+        except Exception:
+            logging.error("Can't parse pushed event")
+            logging.debug(data[:1024])
+            return None
+
+    def __image_path__(self, camera, alert: Optional[EventNotificationAlert], part_name) -> str:
+        anpr = alert.anpr if alert is not None else None
+        plate = anpr.plate if anpr is not None and anpr.plate else "unknown"
+        date = datetime.datetime.now()
+        name = f"{_safe_name(plate)}_{date.strftime('%Y_%d_%m-%H_%M_%S_%f')}_{_safe_name(part_name)}"
+        if not name.lower().endswith(".jpg"):
+            name += ".jpg"
+        if self.image_storage is not None:
+            return self.image_storage.path_for(camera or "push", name, date)
+        return os.path.join(self.path, name)
+
+    def __dispatch__(self, event: PushEvent):
+        if self.image_storage is not None:
+            for _, path, size in event.images:
+                self.image_storage.register(path, size, camera=event.camera or "")
+        if self.callback is None and self.fixation_store is None and self.watchlist is None:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logging.error(f"Push receiver queue full, dropped: {event}")
+
+    def __worker__(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            try:
+                plate = event.plate
+                if plate and plate != "unknown":
+                    date_time = event.alert.timestamp or datetime.datetime.now()
+                    if date_time.tzinfo is not None:
+                        # В журнале локальное время, как у опроса
+                        date_time = date_time.astimezone().replace(tzinfo=None)
+                    image_path = max(event.images, key=lambda image: image[2])[1] if event.images else None
+                    if self.fixation_store is not None:
+                        self.fixation_store.add(event.camera, date_time, plate, color=event.alert.anpr.color,
+                                                image_path=image_path)
+                    if self.watchlist is not None:
+                        self.watchlist.check(plate, camera=event.camera, date_time=date_time, image_path=image_path)
+                if self.callback is not None:
+                    self.callback(event)
+            except Exception:
+                logging.error(f"Push event handling failed: {event}")
+                logging.debug(traceback.format_exc())
+
+
+class _Part:
+    __slots__ = ("headers", "name", "xml", "file", "path", "size", "_data")
+
+    def __init__(self, headers: dict):
+        self.headers = headers
+        self.name = _part_name(headers)
+        # Тип части решаем по первому куску тела
+        self.xml = None
+        self.file = None
+        self.path = None
+        self.size = 0
+        self._data = bytearray()
+
+    def is_xml(self, first_chunk: bytes) -> bool:
+        content_type = self.headers.get("content-type", "")
+        if "image" in content_type or "octet-stream" in content_type:
+            return False
+        return "xml" in content_type or first_chunk.lstrip()[:1] == b"<"
+
+    def open(self, path):
+        self.path = path
+        self.file = open(path + ".part", 'wb')
+
+    def write(self, chunk: bytes):
+        if self.file is not None:
+            self.file.write(chunk)
+            self.size += len(chunk)
+        else:
+            self._data += chunk
+            if len(self._data) > MAX_XML_SIZE:
+                raise ValueError(f"Pushed xml part is too large: {self.name}")
+
+    def data(self) -> bytes:
+        return bytes(self._data)
+
+    def close(self) -> Tuple[str, str, int]:
+        self.file.close()
+        os.replace(self.path + ".part", self.path)
+        logging.debug(f"Pushed image: {self.path}, size: {self.size}")
+        return self.name, self.path, self.size
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path + ".part")
+
+
+def _part_name(headers: dict) -> str:
+    disposition = headers.get("content-disposition", "")
+    match = re.search(r'filename="?([^";]+)"?', disposition) or re.search(r'name="?([^";]+)"?', disposition)
+    return match.group(1) if match else "image"
+
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^0-9A-Za-z._-]+", "_", value)
+
+
+def _read_body(rfile, headers) -> iter:
+    """Body chunks of a request with Content-Length or chunked transfer encoding"""
+    if "chunked" in headers.get("Transfer-Encoding", "").lower():
+        while True:
+            size = int(rfile.readline().split(b";", 1)[0].strip() or b"0", 16)
+            if size == 0:
+                # Трейлеры до пустой строки
+                while rfile.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size:
+                chunk = rfile.read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    return
+                size -= len(chunk)
+                yield chunk
+            rfile.readline()
+    length = int(headers.get("Content-Length") or 0)
+    while length:
+        chunk = rfile.read(min(length, CHUNK_SIZE))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+def _handler(receiver: PushReceiver):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logging.debug("Push receiver: " + format % args)
+
+        def __reply__(self, code):
+            self.send_response(code)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            camera = self.client_address[0]
+            try:
+                event = receiver.receive(camera, self.headers.get("Content-Type", ""),
+                                         _read_body(self.rfile, self.headers))
+            except Exception:
+                with receiver._lock:
+                    receiver.errors += 1
+                logging.error(f"Push from {camera} failed")
+                logging.debug(traceback.format_exc())
+                self.close_connection = True
+                self.__reply__(400)
+                return
+            # Отвечаем сразу, обработка события - в потоках receiver
+            self.__reply__(200)
+            with receiver._lock:
+                receiver.received += 1
+            logging.debug(f"Pushed: {event}")
+            receiver.__dispatch__(event)
+
+        do_PUT = do_POST
+
+    return Handler
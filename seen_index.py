@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class SeenIndex:
+    """Bounded set of already processed playback uri.
+    O(1) lookup, oldest entries are evicted by age and by size.
+    Entries whose event time is at or after keep_after (the polling watermark) are never evicted:
+    the next search window returns them again.
+    With path set the index is saved to a small json file and loaded on start.
+    """
+
+    def __init__(self, max_size=10000, max_age=3600, path=None, save_interval=5.0):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.path = path
+        self.save_interval = save_interval
+        self.keep_after = None
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0.0
+        if path is not None:
+            self.load()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            self.__evict__(time.time())
+            if key in self._items:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, key, event_time=None):
+        """event_time: timestamp of the event, compared with keep_after on eviction"""
+        now = time.time()
+        with self._lock:
+            self._items[key] = (now, event_time)
+            self._items.move_to_end(key)
+            self._dirty = True
+            self.__evict__(now)
+        if self.path is not None and now - self._last_save >= self.save_interval:
+            self.save()
+
+    def __evict__(self, now):
+        border = now - self.max_age if self.max_age else None
+        # Защищенные водяным знаком записи переносятся в конец с новым временем, порядок по времени сохраняется.
+        # Если защищены все, индекс временно больше max_size
+        kept = 0
+        while self._items and kept < len(self._items):
+            key, (added, event_time) = next(iter(self._items.items()))
+            if len(self._items) <= self.max_size and (border is None or added >= border):
+                break
+            if self.keep_after is not None and event_time is not None and event_time >= self.keep_after:
+                self._items[key] = (now, event_time)
+                self._items.move_to_end(key)
+                kept += 1
+            else:
+                self._items.popitem(last=False)
+            self._dirty = True
+
+    def memory_usage(self) -> int:
+        """Approximate size of the index in bytes"""
+        with self._lock:
+            return sys.getsizeof(self._items) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+                                                    for k, v in self._items.items())
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses,
+                "memory": self.memory_usage()}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            logging.error(f"Can't load seen index: {self.path}")
+            return
+        with self._lock:
+            # Старый формат: только время добавления
+            items = {key: tuple(value) if isinstance(value, list) else (value, None) for key, value in items.items()}
+            for key, value in sorted(items.items(), key=lambda x: x[1][0]):
+                self._items[key] = value
+            self.__evict__(time.time())
+        logging.debug(f"Seen index loaded: {self.path}, size: {len(self._items)}")
+
+    def flush(self):
+        """Save the adds not written yet because of save_interval"""
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        # add() зовут из нескольких потоков загрузки метаданных, старый снимок не должен затереть новый
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = json.dumps(self._items)
+                self._dirty = False
+                self._last_save = time.time()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
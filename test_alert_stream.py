@@ -0,0 +1,53 @@
+from alert_stream import MultipartStreamParser
+
+ALERT = b"<EventNotificationAlert><eventType>ANPR</eventType></EventNotificationAlert>"
+IMAGE = b"\xff\xd8" + bytes(range(256)) * 4 + b"\r\n-" + b"\xff\xd9"
+
+
+def _body(with_length: bool) -> bytes:
+    parts = []
+    for content_type, payload in (("application/xml", ALERT), ("image/jpeg", IMAGE)):
+        headers = f"Content-Type: {content_type}\r\n"
+        if with_length:
+            headers += f"Content-Length: {len(payload)}\r\n"
+        parts.append(b"--boundary\r\n" + headers.encode() + b"\r\n" + payload + b"\r\n")
+    return b"".join(parts) + b"--boundary\r\n"
+
+
+def _feed(parser, data: bytes, chunk_size: int) -> list:
+    parts = []
+    for offset in range(0, len(data), chunk_size):
+        parts += parser.feed(data[offset:offset + chunk_size])
+    return parts
+
+
+def test_feed_returns_parts_for_any_chunking():
+    for with_length in (True, False):
+        data = _body(with_length)
+        for chunk_size in (1, 2, 7, 64, len(data)):
+            parts = _feed(MultipartStreamParser("boundary"), data, chunk_size)
+            assert [body for _, body in parts] == [ALERT, IMAGE], (with_length, chunk_size)
+            assert parts[1][0]["content-type"] == "image/jpeg"
+
+
+def test_feed_learns_boundary():
+    parts = MultipartStreamParser().feed(_body(True))
+    assert [body for _, body in parts] == [ALERT, IMAGE]
+
+
+def test_feed_stream_events():
+    for with_length in (True, False):
+        parser = MultipartStreamParser("boundary")
+        data = _body(with_length)
+        bodies, current, headers = [], bytearray(), []
+        for offset in range(0, len(data), 5):
+            for event, value in parser.feed_stream(data[offset:offset + 5]):
+                if event == MultipartStreamParser.EVENT_HEADERS:
+                    headers.append(value)
+                elif event == MultipartStreamParser.EVENT_DATA:
+                    current += value
+                else:
+                    bodies.append(bytes(current))
+                    current = bytearray()
+        assert bodies == [ALERT, IMAGE], with_length
+        assert [h["content-type"] for h in headers] == ["application/xml", "image/jpeg"]
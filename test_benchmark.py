@@ -0,0 +1,25 @@
+import argparse
+
+from benchmark import check, run, ALLOC_LIMITS
+from fake_camera import AUTH_DIGEST
+
+IMAGE_SIZE = 512 * 1024
+
+
+def test_benchmark_within_alloc_limits():
+    args = argparse.Namespace(auth=AUTH_DIGEST, latency=0.0, image_size=IMAGE_SIZE, plate_ratio=1.0, matches=5,
+                              iterations=10)
+    results = run(args)
+    assert {r["name"] for r in results} >= set(ALLOC_LIMITS)
+    assert check(results, IMAGE_SIZE) == []
+    # Сравнение с самим собой проходит
+    assert check(results, IMAGE_SIZE, baseline=results) == []
+
+
+def test_check_reports_regressions():
+    baseline = [{"name": "download", "ops_per_sec": 100.0, "alloc_peak_bytes": 1000}]
+    slower = [{"name": "download", "ops_per_sec": 70.0, "alloc_peak_bytes": 1000}]
+    larger = [{"name": "download", "ops_per_sec": 100.0, "alloc_peak_bytes": IMAGE_SIZE * 2}]
+    assert len(check(slower, IMAGE_SIZE, baseline)) == 1
+    assert len(check(larger, IMAGE_SIZE, baseline)) == 2
+    assert check(slower, IMAGE_SIZE, baseline, tolerance=0.5) == []
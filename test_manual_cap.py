@@ -0,0 +1,80 @@
+from manual_cap import JpegEndScanner, decode_frame, find_jpegs, plate_at, MANUAL_CAP_IMAGE_OFFSET, \
+    MANUAL_CAP_PLATE_START, MANUAL_CAP_PLATE_END
+
+RESPONSE_STATUS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<ResponseStatus version="1.0" xmlns="http://www.hikvision.com/ver20/XMLSchema">
+<statusCode>6</statusCode><statusString>Device Busy</statusString></ResponseStatus>"""
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    return bytes((0xff, marker)) + (len(payload) + 2).to_bytes(2, "big") + payload
+
+
+def _jpeg(scan: bytes = b"\x12\x34" * 100) -> bytes:
+    # EXIF миниатюра со своими SOI/EOI внутри APP1 не должна закончить кадр
+    thumbnail = b"\xff\xd8\xff\xdb\x00\x02\xff\xd9"
+    return b"\xff\xd8" + _segment(0xe1, b"Exif\x00\x00" + thumbnail) + _segment(0xda, bytes(6)) + scan + b"\xff\xd9"
+
+
+def _frame(plate: bytes, *images: bytes) -> bytes:
+    header = bytearray(MANUAL_CAP_IMAGE_OFFSET)
+    header[MANUAL_CAP_PLATE_START:MANUAL_CAP_PLATE_START + len(plate)] = plate
+    return bytes(header) + b"".join(images)
+
+
+def test_find_jpegs_skips_exif_thumbnail():
+    scene, crop = _jpeg(b"\x55" * 5000), _jpeg(b"\x66" * 50)
+    data = b"header" + scene + crop + b"tail"
+    start = len(b"header")
+    assert find_jpegs(data) == [(start, start + len(scene)), (start + len(scene), start + len(scene) + len(crop))]
+
+
+def test_find_jpegs_without_end():
+    truncated = b"\xff\xd8" + _segment(0xda, bytes(6)) + b"\x12\x34" * 100
+    assert find_jpegs(b"header" + truncated) == []
+
+
+def test_jpeg_end_scanner_matches_find_jpegs_for_any_chunking():
+    image = _jpeg(b"\x10\xff\x00\x20" * 30)
+    data = image + b"\xff\xd8\xff next image"
+    expected = find_jpegs(data)[0][1]
+    for chunk_size in range(1, 20):
+        scanner = JpegEndScanner()
+        end = -1
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            position = scanner.feed(chunk)
+            if position >= 0:
+                end = offset + position
+                break
+        assert end == expected, chunk_size
+
+
+def test_decode_frame_scene_and_plate_image():
+    scene, crop = _jpeg(b"\x55" * 5000), _jpeg(b"\x66" * 50)
+    frame = decode_frame(_frame(b"A123BC77", crop, scene))
+    assert frame.plate == "A123BC77"
+    assert frame.recognized
+    assert bytes(frame.scene) == scene
+    assert bytes(frame.plate_image) == crop
+
+
+def test_decode_frame_status():
+    frame = decode_frame(RESPONSE_STATUS)
+    assert frame.status == "Device Busy"
+    assert not frame.images
+
+
+def test_plate_at_reads_only_the_plate_field():
+    field = MANUAL_CAP_PLATE_END - MANUAL_CAP_PLATE_START
+    data = bytearray(MANUAL_CAP_IMAGE_OFFSET)
+    data[MANUAL_CAP_PLATE_START:MANUAL_CAP_PLATE_END] = b"A123BC777RUS"[:field]
+    data[MANUAL_CAP_PLATE_END:MANUAL_CAP_PLATE_END + 4] = b"\x01\x02\xff\xfe"
+    assert plate_at(data) == "A123BC777RUS"[:field]
+
+
+def test_plate_at_strips_nul_padding():
+    data = bytearray(MANUAL_CAP_IMAGE_OFFSET)
+    data[MANUAL_CAP_PLATE_START:MANUAL_CAP_PLATE_START + 10] = b"\x00\x00A123BC77"
+    assert plate_at(data) == "A123BC77"
+    assert plate_at(bytearray(MANUAL_CAP_IMAGE_OFFSET)) is None
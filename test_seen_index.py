@@ -0,0 +1,77 @@
+import json
+import time
+
+from fake_camera import FakeCamera, FakeCameraConfig
+from hikvision_client import HikvisionClient
+from seen_index import SeenIndex
+
+
+def test_evicts_by_size_and_age():
+    index = SeenIndex(max_size=2, max_age=0.05)
+    for key in ("a", "b", "c"):
+        index.add(key)
+    assert "a" not in index
+    assert "b" in index and "c" in index
+    time.sleep(0.1)
+    assert "c" not in index
+    assert len(index) == 0
+
+
+def test_keeps_entries_at_or_after_keep_after():
+    index = SeenIndex(max_size=2, max_age=0.05)
+    index.keep_after = 100.0
+    index.add("old", event_time=99.0)
+    index.add("watermark", event_time=100.0)
+    index.add("new", event_time=101.0)
+    time.sleep(0.1)
+    assert "old" not in index
+    assert "watermark" in index and "new" in index
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "seen.json")
+    index = SeenIndex(path=path, save_interval=60)
+    index.add("a", event_time=1.0)
+    index.add("b")
+    index.flush()
+    loaded = SeenIndex(path=path)
+    assert "a" in loaded and "b" in loaded
+    # Старый формат: только время добавления
+    with open(path, 'w') as f:
+        json.dump({"c": time.time()}, f)
+    assert "c" in SeenIndex(path=path)
+
+
+def test_watermark_poll_does_not_reprocess_after_eviction(tmp_path):
+    with FakeCamera(FakeCameraConfig(matches=3, match_interval=1)) as camera:
+        client = HikvisionClient(camera.url, "user", "password", watermark_path=str(tmp_path / "watermark"))
+        client.known_play_uri.max_age = 0.2
+        try:
+            assert len(client.get_pictures()) == 3
+            watermark = client.last_time
+            time.sleep(0.3)
+            assert client.get_pictures() == []
+            time.sleep(0.3)
+            assert client.get_pictures() == []
+            assert client.last_time == watermark
+        finally:
+            client.close()
+        # Перезапуск продолжает с водяного знака
+        restarted = HikvisionClient(camera.url, "user", "password", watermark_path=str(tmp_path / "watermark"))
+        assert restarted.last_time == watermark
+        assert restarted.known_play_uri.keep_after == watermark.timestamp()
+
+
+def test_quiet_window_moves_watermark():
+    with FakeCamera(FakeCameraConfig(matches=0)) as camera:
+        client = HikvisionClient(camera.url, "user", "password")
+        client.watermark_margin = 1
+        try:
+            assert client.get_pictures() == []
+            first = client.last_time
+            assert first is not None
+            time.sleep(1.1)
+            client.get_pictures()
+            assert client.last_time > first
+        finally:
+            client.close()
@@ -0,0 +1,40 @@
+from watchlist import _Index, WatchlistEntry, Watchlist, MATCH_EXACT, MATCH_CONFUSION, MATCH_FUZZY
+
+
+def _index(fuzzy: bool) -> _Index:
+    return _Index({"stolen": [WatchlistEntry("A123BC77", "stolen")],
+                   "vip": [WatchlistEntry("O777OO99", "vip"), WatchlistEntry("A123BC77", "vip")]}, fuzzy)
+
+
+def _kinds(found) -> list:
+    return [(entry.list_name, kind) for entry, kind in found]
+
+
+def test_exact_match_in_every_list():
+    assert _kinds(_index(False).match("a123-bc 77")) == [("stolen", MATCH_EXACT), ("vip", MATCH_EXACT)]
+
+
+def test_confusion_match():
+    # 0/O и кириллица, похожая на латиницу
+    assert _kinds(_index(False).match("0777ОО99")) == [("vip", MATCH_CONFUSION)]
+    assert _kinds(_index(False).match("A1238C77")) == [("stolen", MATCH_CONFUSION), ("vip", MATCH_CONFUSION)]
+
+
+def test_fuzzy_match_only_with_fuzzy_index():
+    assert _index(False).match("A12BC77") == []
+    assert _kinds(_index(True).match("A12BC77")) == [("stolen", MATCH_FUZZY), ("vip", MATCH_FUZZY)]
+    assert _kinds(_index(True).match("A1234BC77")) == [("stolen", MATCH_FUZZY), ("vip", MATCH_FUZZY)]
+    assert _index(True).match("A99BC77") == []
+
+
+def test_watchlist_reload_swaps_index():
+    watchlist = Watchlist()
+    try:
+        watchlist.load("stolen", ["A123BC77", ("X001XX77", "note")])
+        assert len(watchlist) == 2
+        watchlist.load("stolen", ["X001XX77"])
+        assert watchlist.match("A123BC77") == []
+        assert watchlist.match("unknown") == []
+        assert _kinds(watchlist.match("x001xx77")) == [("stolen", MATCH_EXACT)]
+    finally:
+        watchlist.close()
@@ -0,0 +1,237 @@
+import logging
+import os
+import queue
+import threading
+import traceback
+from typing import Callable, Dict, Iterable, List
+
+MATCH_EXACT = "exact"
+MATCH_CONFUSION = "confusion"
+MATCH_FUZZY = "fuzzy"
+
+# Символы, которые распознавание путает между собой, и кириллица, похожая на латиницу
+_CONFUSIONS = str.maketrans({
+    "O": "0", "Q": "0", "D": "0",
+    "I": "1", "L": "1",
+    "B": "8",
+    "S": "5",
+    "Z": "2",
+    "G": "6",
+    "А": "A", "В": "8", "Е": "E", "К": "K", "М": "M", "Н": "H", "О": "0", "Р": "P", "С": "C", "Т": "T",
+    "У": "Y", "Х": "X",
+})
+_SEPARATORS = str.maketrans("", "", " -_.|")
+
+
+def canonical(plate: str) -> str:
+    """Plate as it is compared exactly: upper case without separators"""
+    return plate.upper().translate(_SEPARATORS)
+
+
+def normalize(plate: str) -> str:
+    """Canonical plate with every confusable character replaced by one representative"""
+    return canonical(plate).translate(_CONFUSIONS)
+
+
+def _deletions(value: str):
+    return {value[:i] + value[i + 1:] for i in range(len(value))}
+
+
+def _within_one(a: str, b: str) -> bool:
+    """Levenshtein distance of a and b is at most 1"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+class WatchlistEntry:
+    __slots__ = ("plate", "list_name", "note")
+
+    def __init__(self, plate: str, list_name: str, note: str = None):
+        self.plate = plate
+        self.list_name = list_name
+        self.note = note
+
+    def __repr__(self):
+        return f"WatchlistEntry(plate={self.plate}, list={self.list_name})"
+
+
+class WatchlistHit:
+    __slots__ = ("plate", "entry", "match", "camera", "date_time", "image_path")
+
+    def __init__(self, plate: str, entry: WatchlistEntry, match: str, camera=None, date_time=None, image_path=None):
+        self.plate = plate
+        self.entry = entry
+        self.match = match
+        self.camera = camera
+        self.date_time = date_time
+        self.image_path = image_path
+
+    def __repr__(self):
+        return f"WatchlistHit(plate={self.plate}, entry={self.entry.plate}, list={self.entry.list_name}, " \
+               f"match={self.match}, camera={self.camera})"
+
+
+class _Index:
+    """Immutable lookup tables of all lists, rebuilt as a whole on reload"""
+    __slots__ = ("entries", "keys", "exact", "normalized", "deletions")
+
+    def __init__(self, lists: Dict[str, List[WatchlistEntry]], fuzzy: bool):
+        self.entries = [entry for entries in lists.values() for entry in entries]
+        self.keys = [normalize(entry.plate) for entry in self.entries]
+        self.exact = {}
+        self.normalized = {}
+        self.deletions = {} if fuzzy else None
+        for i, entry in enumerate(self.entries):
+            self.exact.setdefault(entry.plate, []).append(i)
+            key = self.keys[i]
+            self.normalized.setdefault(key, []).append(i)
+            if fuzzy:
+                for deletion in _deletions(key):
+                    self.deletions.setdefault(deletion, []).append(i)
+
+    def match(self, plate: str) -> List[tuple]:
+        found = self.exact.get(canonical(plate))
+        if found:
+            return [(self.entries[i], MATCH_EXACT) for i in found]
+        key = normalize(plate)
+        found = self.normalized.get(key)
+        if found:
+            return [(self.entries[i], MATCH_CONFUSION) for i in found]
+        if self.deletions is None:
+            return []
+        # Симметричное удаление: кандидаты по общим удалениям, проверка расстояния
+        candidates = set(self.deletions.get(key, ()))
+        for deletion in _deletions(key):
+            candidates.update(self.normalized.get(deletion, ()))
+            candidates.update(self.deletions.get(deletion, ()))
+        return [(self.entries[i], MATCH_FUZZY) for i in sorted(candidates)
+                if _within_one(key, self.keys[i])]
+
+
+class Watchlist:
+    """Plate lists checked on the recognition path.
+    Lookup is one exact hash, then a hash of confusion-normalized plates (0/O, 8/B, 1/I...),
+    with fuzzy=True also a deletion index for plates one edit away, so the cost does not
+    grow with the lists. load()/reload build a new index aside and swap it in, lookups never
+    wait. Callbacks get every WatchlistHit on a worker thread through a bounded queue.
+    """
+
+    def __init__(self, fuzzy=False, queue_size=1000):
+        self.fuzzy = fuzzy
+        self.hits = 0
+        self.dropped = 0
+        self._lists = {}
+        self._paths = {}
+        self._index = _Index({}, fuzzy)
+        self._callbacks = []
+        self._reload_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self.__worker__, name="watchlist", daemon=True)
+        self._thread.start()
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._index.entries)
+
+    def add_callback(self, callback: Callable[[WatchlistHit], None]):
+        self._callbacks.append(callback)
+
+    def load(self, list_name: str, plates: Iterable):
+        """Replace list_name with plates: strings or (plate, note) pairs"""
+        entries = []
+        for item in plates:
+            plate, note = (item, None) if isinstance(item, str) else item
+            if canonical(plate):
+                entries.append(WatchlistEntry(canonical(plate), list_name, note))
+        with self._reload_lock:
+            lists = dict(self._lists)
+            lists[list_name] = entries
+            index = _Index(lists, self.fuzzy)
+            self._lists = lists
+            self._index = index
+        logging.info(f"Watchlist {list_name}: {len(entries)} plates, total: {len(index.entries)}")
+
+    def load_file(self, list_name: str, path):
+        """Text file, one plate per line with an optional note after a comma, # for comments"""
+        with open(path, 'r', encoding="utf-8") as f:
+            plates = []
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                plate, _, note = line.partition(",")
+                plates.append((plate.strip(), note.strip() or None))
+        self._paths[list_name] = (path, os.path.getmtime(path))
+        self.load(list_name, plates)
+
+    def remove(self, list_name: str):
+        with self._reload_lock:
+            lists = dict(self._lists)
+            lists.pop(list_name, None)
+            self._index = _Index(lists, self.fuzzy)
+            self._lists = lists
+        self._paths.pop(list_name, None)
+
+    def watch(self, interval=5.0):
+        """Reload files passed to load_file when they change"""
+        self._watcher = threading.Thread(target=self.__watch_loop__, args=(interval,), name="watchlist-reload",
+                                         daemon=True)
+        self._watcher.start()
+
+    def match(self, plate: str) -> List[tuple]:
+        """(entry, match kind) for every list entry the plate matches"""
+        if not plate or plate == "unknown":
+            return []
+        return self._index.match(plate)
+
+    def check(self, plate: str, camera=None, date_time=None, image_path=None) -> List[WatchlistHit]:
+        """match() and pass the hits to the callbacks"""
+        hits = [WatchlistHit(plate, entry, kind, camera, date_time, image_path) for entry, kind in self.match(plate)]
+        for hit in hits:
+            self.hits += 1
+            logging.info(f"Watchlist hit: {hit}")
+            if self._callbacks:
+                try:
+                    self._queue.put_nowait(hit)
+                except queue.Full:
+                    self.dropped += 1
+                    logging.error(f"Watchlist queue full, dropped: {hit}")
+        return hits
+
+    def close(self):
+        self._stop.set()
+        self._queue.put(None)
+        self._thread.join()
+
+    def __worker__(self):
+        while True:
+            hit = self._queue.get()
+            if hit is None:
+                return
+            for callback in self._callbacks:
+                try:
+                    callback(hit)
+                except Exception:
+                    logging.error(f"Watchlist callback failed: {hit}")
+                    logging.debug(traceback.format_exc())
+
+    def __watch_loop__(self, interval):
+        while not self._stop.wait(interval):
+            for list_name, (path, mtime) in list(self._paths.items()):
+                try:
+                    if os.path.getmtime(path) != mtime:
+                        self.load_file(list_name, path)
+                except Exception:
+                    logging.error(f"Watchlist reload failed: {path}")
+                    logging.debug(traceback.format_exc())